@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+
+from xspress3 import repack
+
+
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('file', help='hdf5 file to repack')
+parser.add_argument('output', help='repacked hdf5 file to write')
+parser.add_argument('-l', '--layout', default='channel', choices=['frame', 'channel', 'bins'], help='chunk layout')
+parser.add_argument('-c', '--compression', default='lzf', help='compression filter, lzf, gzip or none')
+parser.add_argument('-f', '--frame-block', type=int, default=64, help='frames per chunk')
+parser.add_argument('-b', '--bin-block', type=int, default=512, help='bins per chunk for the bins layout')
+parser.add_argument('--benchmark', action='store_true', help='compare read times of the original and repacked files')
+
+args = parser.parse_args()
+
+
+compression = None if args.compression.lower() == 'none' else args.compression
+
+chunks = repack.repack(args.file, args.output, layout=args.layout, compression=compression,
+                       frame_block=args.frame_block, bin_block=args.bin_block)
+print 'Wrote {out} with chunks {chunks}'.format(out=args.output, chunks=chunks)
+
+if args.benchmark:
+    timings = repack.benchmark(args.file, args.output)
+
+    print '{:<10}{:>12}{:>12}{:>10}'.format('read', 'original', 'repacked', 'speedup')
+    for name, t in sorted(timings.iteritems()):
+        print '{:<10}{:>11.3f}s{:>11.3f}s{:>9.1f}x'.format(name, t['original'], t['repacked'], t['original'] / t['repacked'])
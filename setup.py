@@ -11,9 +11,14 @@ setup(
     license          = 'GPL',
     description      = "Xspress 3 EPICS Device",
     packages         = ['xspress3'],
+    entry_points     = {
+        'console_scripts': [
+            'xspress3-batch = xspress3.batch:main',
+        ],
+    },
     platforms        = ['Windows', 'Linux', 'Mac OS X'],
     install_requires = [
-        'h5py',
+        'h5py>=2.9',
         'numpy'
     ],
     classifiers      = [
@@ -2,12 +2,42 @@
 import time
 import logging
 
+import numpy as np
+
 from monitorpv import MonitorPV
 from epics import caget, caput, PV
 
+from . import aggregate
+from . import subframes as sf
 from . import hdf5
 HDF5 = hdf5.HDF5
 
+from . import calibration
+Calibration = calibration.Calibration
+
+from . import fitting
+PeakFitter = fitting.PeakFitter
+
+from . import manager
+Xspress3Manager = manager.Xspress3Manager
+
+from . import flyscan
+FlyScan = flyscan.FlyScan
+
+from . import rates
+RateMonitor = rates.RateMonitor
+
+from . import repack
+
+from . import sequencer
+Sequencer = sequencer.Sequencer
+SequenceAborted = sequencer.SequenceAborted
+SequenceTimeout = sequencer.SequenceTimeout
+
+from . import summary
+Summary = summary.Summary
+Catalogue = summary.Catalogue
+
 
 class Xspress3:
     """Xspress 3 Device
@@ -24,14 +54,6 @@ class Xspress3:
     """
 
     _sca_count = 7
-    _mcas = []
-    _scalars = []
-    _params = {}
-
-    _num_acquired = None
-    _acquired_iter = 0
-
-    _frame_callbacks = []
 
     _parameters = {
         'exposure_time': ['AcquireTime', 'AcquireTime_RBV', False, {}],
@@ -63,11 +85,23 @@ class Xspress3:
         """
         self.logger = logger or logging.getLogger(__name__)
 
+        self._mcas = []
+        self._scalars = []
+        self._params = {}
+
+        self._num_acquired = None
+        self._acquired_iter = 0
+        self._armed_seq = 0
+
+        self._frame_callbacks = []
+
         self._prefix = prefix
         self._channels = caget(self._pv('NUM_CHANNELS_RBV'))
 
         assert self._channels is not None, 'Could not get number of channels. Is the Xspress 3 IOC running?'
 
+        self._mask = aggregate.channel_mask(self._channels)
+
         self.logger.info('System has {chans} channels'.format(chans=self._channels))
 
 
@@ -132,6 +166,15 @@ class Xspress3:
         self._frame_callbacks.append(callback)
 
 
+    def prefix(self):
+        """ Get the PV prefix of the device
+
+        Returns:
+            prefix (string): the PV prefix
+        """
+        return self._prefix
+
+
     def _pv(self, pv):
         return '{prefix}:{pv}'.format(prefix=self._prefix, pv=pv)
 
@@ -139,10 +182,11 @@ class Xspress3:
 
     def _frame_change(self, **kwargs):
         self._num_acquired = kwargs['value']
-        self.logger.debug('Frame Changed: {frame}'.format(frame=kwargs['value']))
-        for c in range(self._channels):
-            self.logger.debug('  Ch {ch} Time {t} Events {e} Reset {r}'.format(ch=c, t=self.sca(c, 0), e=self.sca(c,3), r=self.sca(c,2)))
-            self.logger.debug('    MCA Counts {cts}'.format(cts=sum(self._mcas[c].value())))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Frame Changed: {frame}'.format(frame=kwargs['value']))
+            for c in range(self._channels):
+                self.logger.debug('  Ch {ch} Time {t} Events {e} Reset {r}'.format(ch=c, t=self.sca(c, 0), e=self.sca(c,3), r=self.sca(c,2)))
+                self.logger.debug('    MCA Counts {cts}'.format(cts=sum(self._mcas[c].value())))
 
         if self.acquiring():
             for c in self._frame_callbacks:
@@ -150,6 +194,11 @@ class Xspress3:
 
         self._acquired_iter += 1
 
+        # Wake _wait_acquiring, frames show an acquisition started even if it has already finished
+        cond = self._acq_status.condition()
+        with cond:
+            cond.notify_all()
+
 
     def dropped_frames(self):
         """ Return the number of dropped frames in the last acquisition
@@ -188,23 +237,27 @@ class Xspress3:
         """
 
         for p,v in kwargs.iteritems():
-            assert p in self._parameters, 'No such parameter {param}'.format(param=p)
-            assert self._parameters[p][0] is not None, 'Parameter {param} is read only'.format(param=p)
+            self._put(p, v)
 
-            if len(self._parameters[p][3]):
-                val = None
-                for k,va in self._parameters[p][3].iteritems():
-                    if v == va:
-                        val = k
+        time.sleep(0.2)
 
-                assert val is not None, 'Invalid value {val} for parameter {param}. Available values are: {vals}'.format(
-                    val=v, param=p, vals=','.join(self._parameters[p][3].values()))
-                caput(self._pv(self._parameters[p][0]), val)
 
-            else:
-                caput(self._pv(self._parameters[p][0]), v)
+    def _put(self, p, v, wait=False):
+        assert p in self._parameters, 'No such parameter {param}'.format(param=p)
+        assert self._parameters[p][0] is not None, 'Parameter {param} is read only'.format(param=p)
 
-        time.sleep(0.2)
+        if len(self._parameters[p][3]):
+            val = None
+            for k,va in self._parameters[p][3].iteritems():
+                if v == va:
+                    val = k
+
+            assert val is not None, 'Invalid value {val} for parameter {param}. Available values are: {vals}'.format(
+                val=v, param=p, vals=','.join(self._parameters[p][3].values()))
+            caput(self._pv(self._parameters[p][0]), val, wait=wait)
+
+        else:
+            caput(self._pv(self._parameters[p][0]), v, wait=wait)
 
 
     def get(self, param=None):
@@ -284,22 +337,44 @@ class Xspress3:
         return self._file_name.value()
 
 
-    def acquire(self):
-        """ Starts an acquisition """
+    def acquire(self, timeout=10):
+        """ Starts an acquisition
+
+        Kwargs:
+            timeout (float): seconds to wait for the acquisition to start, None for forever
+
+        Returns:
+            started (bool): False if the acquisition did not start within the timeout
+        """
 
+        self._arm()
+        time.sleep(0.2)
+        self._start()
+        return self._wait_acquiring(timeout)
+
+    def _arm(self, wait=False):
         self._acquired_iter = 0
         self._num_acquired = 0
+        self._armed_seq = self._acq_status.sequence()
 
-        caput(self._pv('Acquire'), 0)
-        caput(self._pv('ERASE'), 1)
-        time.sleep(0.2)
+        caput(self._pv('Acquire'), 0, wait=wait)
+        caput(self._pv('ERASE'), 1, wait=wait)
+
+    def _start(self):
         caput(self._pv('Acquire'), 1)
 
-        while self._acq_status.value() != 1:
-            self.logger.info('Preparing Acquisition')
-            time.sleep(0.5)
+    def _wait_acquiring(self, timeout=10):
+        self.logger.info('Preparing Acquisition')
+
+        # A short acquisition can finish before it is seen acquiring, so also
+        # accept any status change or frame since arming
+        started = self._acq_status.wait_for(lambda v: v == 1 or self._acq_status.sequence() > self._armed_seq or self._acquired_iter > 0, timeout)
+        if not started:
+            self.logger.error('Acquisition did not start within {t}s'.format(t=timeout))
+            return False
 
         self.logger.info('Acquiring')
+        return True
 
     def stop(self):
         """ Stops an acquisiton """
@@ -342,6 +417,18 @@ class Xspress3:
 
         return self._mcas[chan].value()
 
+    def mcas(self):
+        """ Returns the MCAs for all channels as a single array
+
+        Suitable for passing straight to the bulk processing classes, eg.
+        :class:`xspress3.fitting.PeakFitter`
+
+        Returns:
+            mcas (ndarray): the current MCAs, of shape (channels, bins)
+
+        """
+        return np.array([m.value() for m in self._mcas])
+
     def sca(self, chan, sca):
         """ Returns the specified scalar for the specified channel
 
@@ -368,3 +455,118 @@ class Xspress3:
         assert sca < len(self._scalars[chan]), 'Scalar {sca} > number of scalars {scalars}'.format(chan=sca, channels=self._channels)
 
         return self._scalars[chan][sca].value()
+
+    def scas(self, scalars=None):
+        """ Returns all scalars for all channels as a single array
+
+        Kwargs:
+            scalars (list[int]): scalars to return, defaults to all, see :meth:`sca`
+
+        Returns:
+            scalars (ndarray): the current scalars, of shape (channels, scalars)
+
+        """
+        if scalars is None:
+            return np.array([[s.value() for s in chan] for chan in self._scalars], dtype=float)
+
+        return np.array([[chan[s].value() for s in scalars] for chan in self._scalars], dtype=float)
+
+    def dtcs(self):
+        """ Returns dead time correction factors for all channels
+
+        The built in DTC is disabled, so these are calculated from the live
+        scalars with :func:`xspress3.aggregate.dtc_factors`
+
+        Returns:
+            factors (ndarray): the correction factors, of shape (channels,)
+
+        """
+        return aggregate.dtc_factors(self.scas())
+
+    def set_channel_mask(self, mask=None, exclude=None):
+        """ Set the channels included in summed data
+
+        >>> x3.set_channel_mask(exclude=[3, 5])
+
+        Kwargs:
+            mask (list[bool]): channels to include, defaults to all channels
+
+            exclude (list[int]): bad channels to exclude, zero offset
+
+        """
+        self._mask = aggregate.channel_mask(self._channels, mask, exclude)
+
+    def channel_mask(self):
+        """ Returns the channels included in summed data
+
+        Returns:
+            mask (ndarray): boolean array of shape (channels,)
+
+        """
+        return self._mask.copy()
+
+    def sum_mca(self, dtc=False):
+        """ Returns the MCA summed over the masked channels
+
+        Kwargs:
+            dtc (bool): weight each channel by its dead time correction factor
+
+        Returns:
+            mca (ndarray): the summed MCA (usually 4096 values)
+
+        """
+        weights = self.dtcs() if dtc else None
+        return aggregate.channel_sum(self.mcas(), self._mask, weights, spectra=True)
+
+    def sum_sca(self, sca, dtc=False):
+        """ Returns the specified scalar summed over the masked channels
+
+        Args:
+            sca (int): scalar to sum, see :meth:`sca`
+
+        Kwargs:
+            dtc (bool): weight each channel by its dead time correction factor
+
+        Returns:
+            scalar (float): the summed scalar
+
+        """
+        scalars = self.scas()
+        weights = aggregate.dtc_factors(scalars) if dtc else None
+        return aggregate.channel_sum(scalars[:,sca], self._mask, weights)
+
+    def subframe_mcas(self):
+        """ Returns the MCAs for all channels split into subframes
+
+        Requires the device to be created with subframes enabled
+
+        Returns:
+            mcas (ndarray): the current MCAs, of shape (subframes, channels, bins)
+
+        """
+        assert 'num_subframes' in self._params, 'Subframes are not enabled'
+        return sf.subframe_view(self.mcas(), self._params['num_subframes'].value())
+
+    def merge_subframes(self, factor=None, resolution=None):
+        """ Returns the MCAs for all channels with consecutive subframes merged
+
+        Give either a merge factor or a target time resolution, the subframe
+        duration is taken from the exposure time and number of subframes
+
+        Kwargs:
+            factor (int): number of subframes to merge into each bin
+
+            resolution (float): target time resolution in seconds
+
+        Returns:
+            mcas (ndarray): the merged MCAs, of shape (merged subframes, channels, bins)
+
+        """
+        assert 'num_subframes' in self._params, 'Subframes are not enabled'
+        subframes = self._params['num_subframes'].value()
+
+        if factor is None:
+            assert resolution is not None, 'Either a factor or a resolution is required'
+            factor = sf.merge_factor(resolution, self.get('exposure_time') / float(subframes))
+
+        return sf.merge(self.mcas(), subframes, factor)
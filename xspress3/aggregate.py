@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+def channel_mask(channels, mask=None, exclude=None):
+    """ Build a boolean channel mask
+
+    >>> channel_mask(4, exclude=[2])
+    >>> array([ True,  True, False,  True])
+
+    Args:
+        channels (int): number of channels on the system
+
+    Kwargs:
+        mask (list[bool]): channels to include, defaults to all channels
+
+        exclude (list[int]): bad channels to exclude, zero offset
+
+    Returns:
+        mask (ndarray): boolean array of shape (channels,)
+
+    """
+    if mask is None:
+        mask = np.ones(channels, dtype=bool)
+    else:
+        mask = np.array(mask, dtype=bool)
+
+    assert mask.shape == (channels,), 'Channel mask needs {chans} values, got {n}'.format(chans=channels, n=mask.size)
+
+    if exclude is not None:
+        for c in exclude:
+            assert c < channels, 'Chan {chan} > number of channels {chans}'.format(chan=c, chans=channels)
+            mask[c] = False
+
+    return mask
+
+
+def dtc_factors(scalars):
+    """ Calculate deadtime correction factors from raw scalars
+
+    Combines the reset deadtime, time / (time - reset ticks), with the
+    processing deadtime, all event / all good. This approximates the IOC's own
+    correction, which is disabled while this module is in use
+
+    Args:
+        scalars (ndarray): scalars of shape (..., channels, scalars), ordered as
+        for :meth:`xspress3.Xspress3.sca`
+
+    Returns:
+        factors (ndarray): correction factors of shape (..., channels), 1 where
+        there is no data
+
+    """
+    scalars = np.asarray(scalars, dtype=float)
+    ticks, reset, allevent, allgood = scalars[...,0], scalars[...,1], scalars[...,3], scalars[...,4]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = ticks / (ticks - reset) * allevent / allgood
+        factors[~(factors > 0) | np.isinf(factors)] = 1
+
+    return factors
+
+
+def channel_sum(data, mask, weights=None, spectra=False):
+    """ Sum data over the masked channels
+
+    Args:
+        data (ndarray): per channel data of shape (..., channels) for scalars
+        or (..., channels, bins) for MCAs
+
+        mask (ndarray): boolean channel mask of shape (channels,)
+
+    Kwargs:
+        weights (ndarray): per channel weights of shape (..., channels), eg.
+        deadtime correction factors
+
+        spectra (bool): data are MCAs rather than scalars
+
+    Returns:
+        sum (ndarray): the sum, of shape (...) for scalars or (..., bins) for MCAs
+
+    """
+    data = np.asarray(data)
+    axis = -2 if spectra else -1
+
+    if weights is None:
+        return data.compress(mask, axis=axis).sum(axis=axis)
+
+    weights = np.asarray(weights, dtype=float) * mask
+    if spectra:
+        return np.einsum('...c,...cb->...b', weights, data)
+
+    return (weights * data).sum(axis=-1)
+
+
+def roi_sums(spectra, bounds):
+    """ Integrate ROIs over the last axis of a block of spectra
+
+    One cumulative sum gives every ROI, however many there are. Bounds are
+    clipped to the spectra, so an ROI beyond the last bin sums what it covers
+
+    >>> roi_sums(mcas, [(630, 650), (795, 815)]).shape
+    >>> (100, 4, 2)
+
+    Args:
+        spectra (ndarray): spectra of shape (..., bins)
+
+        bounds (ndarray): (first bin, last bin) of each ROI, of shape (rois, 2)
+
+    Returns:
+        sums (ndarray): ROI sums of shape (..., rois)
+
+    """
+    bounds = np.asarray(bounds, dtype=int).reshape(-1, 2)
+    bins = spectra.shape[-1]
+
+    cs = np.concatenate((np.zeros(spectra.shape[:-1] + (1,)), np.cumsum(spectra, axis=-1)), axis=-1)
+
+    lo = np.clip(bounds[:,0], 0, bins)
+    hi = np.clip(bounds[:,1] + 1, lo, bins)
+
+    return cs[..., hi] - cs[..., lo]
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+
+import h5py
+import numpy as np
+
+from . import aggregate
+from . import hdf5
+from . import summary
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('hdf5', 'npz', 'csv')
+
+
+def output_path(file, outdir, fmt, root=None):
+    """ Returns the output path for a processed file
+
+    Args:
+        file (string): the input hdf5 file
+
+        outdir (string): the output directory, None to write next to the input
+
+        fmt (string): the output format
+
+    Kwargs:
+        root (string): input directory, its structure is mirrored under outdir,
+        defaults to the directory of the file
+
+    Returns:
+        path (string): {outdir}/{name}_processed.{fmt}
+    """
+    base = os.path.splitext(file)[0]
+    if outdir is not None:
+        rel = os.path.relpath(base, root) if root else os.path.basename(base)
+        base = os.path.join(outdir, rel)
+
+    return '{base}_processed.{ext}'.format(base=base, ext=fmt)
+
+
+def common_root(files):
+    """ Returns the deepest directory containing every file
+
+    Args:
+        files (list[string]): the files
+
+    Returns:
+        root (string): the common directory
+    """
+    dirs = [os.path.dirname(os.path.abspath(f)).split(os.sep) for f in files]
+    return os.sep.join(os.path.commonprefix(dirs)) or os.sep
+
+
+def options_path(output):
+    """ Returns the path of the options an output was processed with
+
+    Args:
+        output (string): the output path
+
+    Returns:
+        path (string): {output}.options.json
+    """
+    return '{out}.options.json'.format(out=output)
+
+
+def _options(dtc=False, sum_channels=False, exclude=None, rois=None, rebin=1, fmt='hdf5'):
+    # As they round trip through json
+    return {
+        'dtc': dtc,
+        'sum_channels': sum_channels,
+        'exclude': sorted(exclude) if exclude else None,
+        'rois': dict((n, list(b)) for n, b in (rois or {}).iteritems()),
+        'rebin': rebin,
+        'fmt': fmt,
+    }
+
+
+def is_done(file, output, options=None):
+    """ Returns whether a file has already been processed
+
+    Outputs are only ever created by a rename on completion, and their options
+    are recorded after that, so an output newer than its input with matching
+    options is complete and current
+
+    Args:
+        file (string): the input hdf5 file
+
+        output (string): the output path
+
+    Kwargs:
+        options (dict): the processing options, as the keyword arguments of :func:`process`
+
+    Returns:
+        done (bool): whether the output is up to date
+    """
+    if not os.path.exists(output) or os.path.getmtime(output) < os.path.getmtime(file):
+        return False
+
+    try:
+        with open(options_path(output)) as f:
+            stored = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    return stored == json.loads(json.dumps(_options(**(options or {}))))
+
+
+def process(file, output, dtc=False, sum_channels=False, exclude=None, rois=None, rebin=1, fmt='hdf5', block=1024):
+    """ Process one hdf5 file
+
+    Stages run in order on each block of frames:
+        1. dtc: dead time correct each channel
+        2. sum: sum the channels not excluded
+        3. rois: integrate ROIs, in original bins
+        4. rebin: sum groups of adjacent bins
+        5. export: write spectra and ROI sums, csv holds ROI sums only
+
+    Args:
+        file (string): the input hdf5 file
+
+        output (string): the output path
+
+    Kwargs:
+        dtc (bool): dead time correct
+
+        sum_channels (bool): sum channels
+
+        exclude (list[int]): channels excluded from the sum
+
+        rois (dict): ROI name to (first bin, last bin)
+
+        rebin (int): bins to sum together
+
+        fmt (string): output format, hdf5, npz or csv
+
+        block (int): frames processed at a time
+
+    Returns:
+        frames (int): the number of frames processed
+    """
+    assert sum_channels or not exclude, 'Channels can only be excluded from a sum'
+    assert fmt != 'csv' or rois, 'csv output holds ROI sums only, ROIs are required'
+
+    names = sorted((rois or {}).keys())
+    bounds = np.array([rois[n] for n in names], dtype=int).reshape(-1, 2)
+
+    # The output is not current until it is complete and its options are recorded
+    options = options_path(output)
+    if os.path.exists(options):
+        os.remove(options)
+
+    outdir = os.path.dirname(output)
+    if outdir and not os.path.isdir(outdir):
+        try:
+            os.makedirs(outdir)
+        except OSError:
+            if not os.path.isdir(outdir):
+                raise
+
+    # Write then rename so an interrupted run never leaves a complete looking output
+    tmp = '{out}.tmp'.format(out=output)
+    # npz members are npy files, so the spectra are written as one and added whole
+    npy = '{tmp}.spectra.npy'.format(tmp=tmp)
+
+    try:
+        frames = _write(file, tmp, npy, dtc, sum_channels, exclude, names, bounds, rebin, fmt, block)
+
+    except:
+        for path in (tmp, npy):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    summary.replace(tmp, output)
+
+    with open(tmp, 'w') as f:
+        json.dump(_options(dtc, sum_channels, exclude, rois, rebin, fmt), f)
+    summary.replace(tmp, options)
+
+    return frames
+
+
+def _write(file, tmp, npy, dtc, sum_channels, exclude, names, bounds, rebin, fmt, block):
+    with hdf5.HDF5(file, lazy=True) as h5:
+        size = h5.size()
+        frames = size['frames']
+        assert size['bins'] % rebin == 0, '{bins} bins cannot be rebinned by {n}'.format(bins=size['bins'], n=rebin)
+        assert ((bounds[:,0] >= 0) & (bounds[:,0] <= bounds[:,1]) & (bounds[:,1] < size['bins'])).all(), \
+            'ROIs must lie within the {bins} bins'.format(bins=size['bins'])
+
+        if exclude:
+            h5.set_channel_mask(exclude=exclude)
+
+        # Spectra are written block by block, only the ROI sums are kept in memory
+        out = None
+        if fmt == 'hdf5':
+            out = h5py.File(tmp, 'w')
+        elif fmt == 'npz':
+            out = open(npy, 'wb')
+
+        try:
+            roi_sums = np.zeros((frames, 0))
+            for s in range(0, frames, block):
+                sl = slice(s, min(s+block, frames))
+
+                if sum_channels:
+                    data = h5.sum_mca(sl, dtc=dtc)
+                elif dtc:
+                    data = h5.mcas(sl) * h5.dtcs(sl)[..., np.newaxis]
+                else:
+                    data = h5.mcas(sl)
+
+                if len(names):
+                    sums = aggregate.roi_sums(data, bounds)
+                    if s == 0:
+                        roi_sums = np.zeros((frames,) + sums.shape[1:])
+                    roi_sums[sl] = sums
+
+                if rebin > 1:
+                    data = data.reshape(data.shape[:-1] + (-1, rebin)).sum(axis=-1)
+
+                shape = (frames,) + data.shape[1:]
+                if fmt == 'hdf5':
+                    if s == 0:
+                        spectra = out.create_dataset('spectra', shape, dtype=data.dtype, compression='lzf', shuffle=True)
+                    spectra[sl] = data
+
+                elif fmt == 'npz':
+                    if s == 0:
+                        header = { 'descr': np.lib.format.dtype_to_descr(data.dtype), 'fortran_order': False, 'shape': shape }
+                        np.lib.format.write_array_header_1_0(out, header)
+                    np.ascontiguousarray(data).tofile(out)
+
+            if fmt == 'hdf5':
+                _export_hdf5(out, frames, roi_sums, names)
+
+        finally:
+            if out is not None:
+                out.close()
+
+    if fmt == 'npz':
+        _export_npz(tmp, npy, frames, roi_sums, names)
+    elif fmt == 'csv':
+        _export_csv(tmp, roi_sums, names)
+
+    return frames
+
+
+def _export_hdf5(out, frames, rois, names):
+    if not frames:
+        out.create_dataset('spectra', (0,))
+
+    ds = out.create_dataset('rois', data=rois)
+    ds.attrs['names'] = np.array(names, dtype='S')
+
+
+def _export_npz(tmp, npy, frames, rois, names):
+    with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_STORED, allowZip64=True) as z:
+        if frames:
+            z.write(npy, 'spectra.npy')
+        else:
+            _write_npy(z, 'spectra', np.zeros(0))
+
+        _write_npy(z, 'rois', rois)
+        _write_npy(z, 'roi_names', np.array(names, dtype='S'))
+
+    os.remove(npy)
+
+
+def _export_csv(tmp, rois, names):
+    cols = ['frame']
+    if rois.ndim == 3:
+        cols += ['{roi}_ch{c}'.format(roi=n, c=c) for c in range(rois.shape[1]) for n in names]
+    else:
+        cols += names
+
+    table = np.column_stack((np.arange(rois.shape[0]), rois.reshape(rois.shape[0], int(np.prod(rois.shape[1:])))))
+    np.savetxt(tmp, table, delimiter=',', header=','.join(cols), comments='', fmt='%.10g')
+
+
+def _write_npy(z, name, array):
+    buf = io.BytesIO()
+    np.lib.format.write_array(buf, np.asanyarray(array))
+    z.writestr('{name}.npy'.format(name=name), buf.getvalue())
+
+
+def _run(task):
+    file, output, options = task
+
+    start = time.time()
+    try:
+        frames = process(file, output, **options)
+        return file, frames, time.time() - start, None
+
+    except Exception as e:
+        return file, 0, time.time() - start, '{type}: {err}'.format(type=type(e).__name__, err=e)
+
+
+def _parse_roi(roi):
+    try:
+        name, lo, hi = roi.split(':')
+        return name, (int(lo), int(hi))
+
+    except ValueError:
+        raise argparse.ArgumentTypeError('ROI must be name:first:last, got {roi}'.format(roi=roi))
+
+
+def main(argv=None):
+    """ Process many Xspress 3 hdf5 files
+
+    Installed as the xspress3-batch console script
+
+    .. code-block:: bash
+
+        xspress3-batch /data/beamtime -o /data/processed --dtc --sum --exclude 3 \\
+            --roi Fe:630:650 --roi Cu:795:815 --rebin 4 -j 8
+
+    Args:
+        argv (list[string]): command line arguments, defaults to sys.argv
+
+    Returns:
+        status (int): 0 if every file was processed
+    """
+    parser = argparse.ArgumentParser(description='Batch process Xspress 3 hdf5 files')
+    parser.add_argument('paths', nargs='+', help='hdf5 files, globs or directories')
+    parser.add_argument('-o', '--output', help='output directory, defaults to next to each file')
+    parser.add_argument('--pattern', default='*.hdf5', help='file pattern to match in directories')
+    parser.add_argument('--dtc', action='store_true', help='dead time correct')
+    parser.add_argument('--sum', action='store_true', help='sum channels')
+    parser.add_argument('--exclude', type=lambda s: [int(c) for c in s.split(',')], help='comma separated bad channels to exclude from the sum')
+    parser.add_argument('--roi', type=_parse_roi, action='append', default=[], help='ROI to integrate as name:first:last bins, repeatable')
+    parser.add_argument('--rebin', type=int, default=1, help='number of bins to sum together')
+    parser.add_argument('-f', '--format', default='hdf5', choices=FORMATS, help='output format, csv holds ROI sums only')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes')
+    parser.add_argument('--force', action='store_true', help='reprocess files that already have an up to date output')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log each file')
+
+    args = parser.parse_args(argv)
+    if args.exclude and not args.sum:
+        parser.error('--exclude only applies with --sum')
+
+    if args.format == 'csv' and not args.roi:
+        parser.error('csv output holds ROI sums only, at least one --roi is required')
+
+    for name, (lo, hi) in args.roi:
+        if lo < 0 or lo > hi:
+            parser.error('ROI {name} must have 0 <= first <= last, got {lo}:{hi}'.format(name=name, lo=lo, hi=hi))
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    options = {
+        'dtc': args.dtc,
+        'sum_channels': args.sum,
+        'exclude': args.exclude,
+        'rois': dict(args.roi),
+        'rebin': args.rebin,
+        'fmt': args.format,
+    }
+
+    tasks, skipped, outputs = [], 0, {}
+    for path in args.paths:
+        # Don't take outputs written next to their inputs as inputs
+        files = [f for f in summary.find_files(path, args.pattern) if not os.path.splitext(f)[0].endswith('_processed')]
+        if not files:
+            continue
+
+        # Files from a glob keep their paths below the directories they share
+        root = path if os.path.isdir(path) else common_root(files)
+        for file in files:
+            output = output_path(file, args.output, args.format, root)
+
+            key = os.path.abspath(output)
+            if key in outputs:
+                if os.path.abspath(outputs[key]) != os.path.abspath(file):
+                    parser.error('{a} and {b} would both be written to {out}'.format(a=outputs[key], b=file, out=output))
+                continue
+            outputs[key] = file
+
+            if not args.force and is_done(file, output, options):
+                skipped += 1
+            else:
+                tasks.append((file, output, options))
+
+    print 'Processing {n} files, {s} already done'.format(n=len(tasks), s=skipped)
+    if not tasks:
+        return 0
+
+    start = time.time()
+    done, frames, failed = 0, 0, []
+
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        for file, nframes, took, error in pool.imap_unordered(_run, tasks):
+            done += 1
+            frames += nframes
+
+            if error is not None:
+                failed.append(file)
+                logger.error('{file}: {err}'.format(file=file, err=error))
+            else:
+                logger.info('{file}: {frames} frames in {t:.1f}s'.format(file=file, frames=nframes, t=took))
+
+            elapsed = time.time() - start
+            rate = done / elapsed
+            sys.stdout.write('\r{d}/{n} files  {fps:.1f} files/s  {frs:.0f} frames/s  ETA {eta:.0f}s  '.format(
+                d=done, n=len(tasks), fps=rate, frs=frames / elapsed, eta=(len(tasks) - done) / rate))
+            sys.stdout.flush()
+
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print
+    print 'Processed {d} files, {f} frames in {t:.1f}s ({fps:.1f} files/s, {frs:.0f} frames/s), {e} failed'.format(
+        d=done - len(failed), f=frames, t=elapsed, fps=done / elapsed, frs=frames / elapsed, e=len(failed))
+
+    for file in failed:
+        print '  Failed: {file}'.format(file=file)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class Calibration:
+    """Xspress 3 Energy Calibration
+
+    A per channel linear energy calibration, energy = gain * bin + offset,
+    with energies in eV
+
+    Example:
+      >>> cal = Calibration(4, gain=10)
+      >>> cal.energy(0)[:3]
+      >>>
+      >>> array([  0.,  10.,  20.])
+    """
+
+    def __init__(self, channels, gain=10.0, offset=0.0, bins=4096):
+        """ Create an energy calibration
+
+        Args:
+            channels (int): number of channels to calibrate
+
+        Kwargs:
+            gain (float|list[float]): eV per bin, either one value or one per channel
+
+            offset (float|list[float]): energy of bin 0 in eV, either one value or one per channel
+
+            bins (int): number of bins per mca
+
+        """
+        self._channels = channels
+        self._bins = bins
+        self._gain = self._per_channel(gain, 'gain')
+        self._offset = self._per_channel(offset, 'offset')
+
+
+    def _per_channel(self, value, name):
+        value = np.asarray(value, dtype=float)
+        if value.ndim == 0:
+            value = np.repeat(value, self._channels)
+
+        assert value.shape == (self._channels,), 'Calibration {name} needs 1 or {chans} values, got {n}'.format(
+            name=name, chans=self._channels, n=value.size)
+
+        return value
+
+
+    @classmethod
+    def load(cls, file, bins=4096):
+        """ Load a calibration from a text file
+
+        The file has one line per channel of ``gain offset``
+
+        Args:
+            file (string): the calibration file to load
+
+        Returns:
+            calibration (Calibration): the loaded calibration
+
+        """
+        table = np.atleast_2d(np.loadtxt(file, dtype=float))
+        return cls(table.shape[0], gain=table[:,0], offset=table[:,1], bins=bins)
+
+
+    def save(self, file):
+        """ Save the calibration to a text file
+
+        Args:
+            file (string): the file to save to
+
+        """
+        np.savetxt(file, np.column_stack((self._gain, self._offset)), header='gain offset')
+
+
+    def channels(self):
+        """ Returns the number of channels calibrated
+
+        Returns:
+            channels (int): the number of channels
+        """
+        return self._channels
+
+
+    def bins(self):
+        """ Returns the number of bins per mca
+
+        Returns:
+            bins (int): the number of bins
+        """
+        return self._bins
+
+
+    def gain(self, chan=None):
+        """ Returns the gain in eV per bin
+
+        Kwargs:
+            chan (int): channel to return the gain for, defaults to all channels
+
+        Returns:
+            gain (float|ndarray): the gain
+        """
+        return self._gain if chan is None else self._gain[chan]
+
+
+    def offset(self, chan=None):
+        """ Returns the offset in eV
+
+        Kwargs:
+            chan (int): channel to return the offset for, defaults to all channels
+
+        Returns:
+            offset (float|ndarray): the offset
+        """
+        return self._offset if chan is None else self._offset[chan]
+
+
+    def energy(self, chan=None, bins=None):
+        """ Returns the energy of each bin
+
+        Kwargs:
+            chan (int): channel to return energies for, defaults to all channels
+
+            bins (ndarray): bin indices to convert, defaults to every bin
+
+        Returns:
+            energy (ndarray): energies in eV, of shape (bins,) for one channel
+            or (channels, bins) for all channels
+
+        """
+        if bins is None:
+            bins = np.arange(self._bins)
+        bins = np.asarray(bins, dtype=float)
+
+        if chan is not None:
+            return self._gain[chan] * bins + self._offset[chan]
+
+        return self._gain[:,np.newaxis] * bins + self._offset[:,np.newaxis]
+
+
+    def bin(self, energy, chan=None):
+        """ Returns the (fractional) bin for an energy
+
+        Args:
+            energy (float): the energy in eV
+
+        Kwargs:
+            chan (int): channel to convert for, defaults to all channels
+
+        Returns:
+            bin (float|ndarray): the bin for the energy
+
+        """
+        if chan is not None:
+            return (energy - self._offset[chan]) / self._gain[chan]
+
+        return (energy - self._offset) / self._gain
+
+
+    def window(self, emin, emax):
+        """ Returns the bin window covering an energy range on every channel
+
+        Args:
+            emin (float): lower energy in eV
+
+            emax (float): upper energy in eV
+
+        Returns:
+            window (slice): bins covering the range on all channels
+
+        """
+        lo = int(np.floor(np.min(self.bin(emin))))
+        hi = int(np.ceil(np.max(self.bin(emax)))) + 1
+
+        return slice(max(lo, 0), min(hi, self._bins))
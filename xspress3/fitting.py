@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+
+import numpy as np
+
+from . import hdf5
+
+
+logger = logging.getLogger(__name__)
+
+FWHM_TO_SIGMA = 1.0 / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+
+
+class PeakFitter:
+    """Batched Gaussian Peak Fitter
+
+    Fits a set of Gaussian emission lines of known energy and width on top of
+    a linear background. With the line positions fixed the model is linear in
+    the peak amplitudes and background terms, so the least squares solution for
+    every channel is precomputed once and a whole frames x channels block is
+    fitted with a single matrix product.
+
+    Example:
+      >>> cal = Calibration(4, gain=10)
+      >>> fitter = PeakFitter(cal, {'Fe Ka': 6404, 'Fe Kb': 7058})
+      >>> with HDF5(file) as h5:
+      >>>     res = fitter.fit(h5.mcas())
+      >>> res['area'].shape
+      >>>
+      >>> (100, 4, 2)
+    """
+
+    def __init__(self, calibration, lines, fwhm=150.0, window=None, background=True):
+        """ Create a peak fitter
+
+        Args:
+            calibration (Calibration): energy calibration of the detector
+
+            lines (dict): line name to energy in eV
+
+        Kwargs:
+            fwhm (float|callable): peak fwhm in eV, or a function of energy returning
+            the fwhm. Must be a module level function to fit in a process pool
+
+            window (tuple): (emin, emax) energy range in eV to fit over, defaults to
+            3 fwhm either side of the lines
+
+            background (bool): fit a linear background under the peaks
+
+        """
+        self._cal = calibration
+        self._names = sorted(lines.keys(), key=lambda n: lines[n])
+        self._energies = np.array([lines[n] for n in self._names], dtype=float)
+
+        assert len(self._names), 'At least one line is required'
+
+        if callable(fwhm):
+            self._fwhm = np.array([fwhm(e) for e in self._energies], dtype=float)
+        else:
+            self._fwhm = np.repeat(float(fwhm), len(self._names))
+
+        if window is None:
+            window = (self._energies.min() - 3*self._fwhm.max(), self._energies.max() + 3*self._fwhm.max())
+
+        self._emin, self._emax = window
+        self._window = calibration.window(self._emin, self._emax)
+        self._background = background
+
+        self._build()
+
+
+    def _build(self):
+        bins = np.arange(self._window.start, self._window.stop)
+        self._e = self._cal.energy(bins=bins)
+        self._inside = ((self._e >= self._emin) & (self._e <= self._emax)).astype(float)
+
+        sigma = self._fwhm * FWHM_TO_SIGMA
+        model = [np.exp(-0.5 * ((self._e[:,:,np.newaxis] - self._energies) / sigma)**2)]
+
+        if self._background:
+            centre = 0.5 * (self._emin + self._emax)
+            span = 0.5 * (self._emax - self._emin)
+            model.append(np.ones(self._e.shape + (1,)))
+            model.append(((self._e - centre) / span)[:,:,np.newaxis])
+
+        design = np.concatenate(model, axis=2) * self._inside[:,:,np.newaxis]
+
+        # (channels, params, window) least squares operator
+        self._pinv = np.linalg.pinv(design)
+
+        # Integral of a unit height peak in counts, per channel and line
+        self._area = np.sqrt(2*np.pi) * sigma / self._cal.gain()[:,np.newaxis]
+
+
+    def lines(self):
+        """ Returns the fitted line names, in order of energy
+
+        Returns:
+            lines (list[string]): line names as indexed in the fit results
+        """
+        return list(self._names)
+
+
+    def window(self):
+        """ Returns the bins used in the fit
+
+        Returns:
+            window (slice): the bin window fitted on every channel
+        """
+        return self._window
+
+
+    def _block(self, spectra):
+        spectra = np.asarray(spectra)
+        chans, bins = self._cal.channels(), self._cal.bins()
+
+        assert spectra.shape[-2:] == (chans, bins), 'Spectra of shape {shape} do not match calibration ({chans}, {bins})'.format(
+            shape=spectra.shape, chans=chans, bins=bins)
+
+        lead = spectra.shape[:-2]
+        y = spectra[..., self._window].reshape((-1, chans, self._e.shape[1])).astype(float)
+
+        return lead, y
+
+
+    def fit(self, spectra):
+        """ Fit a block of spectra
+
+        Args:
+            spectra (ndarray): spectra of shape (..., channels, bins), eg. a single
+            live frame (channels, bins) or a block of frames (frames, channels, bins)
+
+        Returns:
+            result (dict): arrays with the leading shape of spectra
+
+                * amplitude (ndarray): peak heights, (..., channels, lines)
+                * area (ndarray): peak areas in counts, (..., channels, lines)
+                * background (ndarray): constant and slope, (..., channels, 2)
+
+        """
+        lead, y = self._block(spectra)
+        nlines = len(self._names)
+
+        # (channels, params, window) x (channels, window, spectra)
+        coeffs = np.matmul(self._pinv, y.transpose(1, 2, 0)).transpose(2, 0, 1)
+        coeffs = coeffs.reshape(lead + coeffs.shape[1:])
+
+        amplitude = coeffs[..., :nlines]
+        return {
+            'amplitude': amplitude,
+            'area': amplitude * self._area,
+            'background': coeffs[..., nlines:],
+        }
+
+
+    def moments(self, spectra):
+        """ Calculate the moments of a block of spectra over the fit window
+
+        A fast alternative to fitting for isolated lines
+
+        Args:
+            spectra (ndarray): spectra of shape (..., channels, bins)
+
+        Returns:
+            result (dict): arrays of shape (..., channels)
+
+                * counts (ndarray): total counts in the window
+                * centroid (ndarray): mean energy in eV
+                * fwhm (ndarray): gaussian equivalent fwhm in eV
+
+        """
+        lead, y = self._block(spectra)
+        y = y * self._inside
+
+        counts = y.sum(axis=2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m1 = (y * self._e).sum(axis=2) / counts
+            m2 = (y * self._e**2).sum(axis=2) / counts
+
+        fwhm = np.sqrt(np.clip(m2 - m1**2, 0, None)) / FWHM_TO_SIGMA
+
+        return {
+            'counts': counts.reshape(lead + counts.shape[1:]),
+            'centroid': m1.reshape(lead + m1.shape[1:]),
+            'fwhm': fwhm.reshape(lead + fwhm.shape[1:]),
+        }
+
+
+
+def _fit_block(args):
+    file, fitter, method, start, stop = args
+    with hdf5.HDF5(file, lazy=True) as h5:
+        return getattr(fitter, method)(h5.mcas(slice(start, stop)))
+
+
+def fit_file(file, fitter, block=1024, processes=0, method='fit'):
+    """ Fit every frame of an hdf5 file
+
+    Frames are read and fitted in blocks so the whole file is never held in
+    memory. Blocks can optionally be farmed out to a process pool
+
+    >>> res = fit_file('/data/test1.hdf5', fitter, processes=4)
+    >>> res['area'][:,:,0].sum(axis=1)  # summed area of the first line per frame
+
+    Args:
+        file (string): the hdf5 file to fit
+
+        fitter (PeakFitter): the fitter to use
+
+    Kwargs:
+        block (int): number of frames per block
+
+        processes (int): number of worker processes, 0 to fit in this process
+
+        method (string): fitter method to run, fit or moments
+
+    Returns:
+        result (dict): the fit results for every frame, see PeakFitter.fit
+
+    """
+    assert method in ('fit', 'moments'), 'No such method {method}'.format(method=method)
+
+    with hdf5.HDF5(file, lazy=True) as h5:
+        frames = h5.size()['frames']
+
+    # An empty file still runs one empty block, for results of the right shape
+    jobs = [(file, fitter, method, s, min(s+block, frames)) for s in range(0, frames, block)] or [(file, fitter, method, 0, 0)]
+    logger.info('Fitting {frames} frames of {file} in {n} blocks'.format(frames=frames, file=file, n=len(jobs)))
+
+    if processes:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_fit_block, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_fit_block(j) for j in jobs]
+
+    return dict((k, np.concatenate([r[k] for r in results])) for k in results[0])
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+import numpy as np
+
+from . import aggregate
+from .monitorpv import MonitorPV
+
+
+def raster_index(shape, snake=False):
+    """ Returns the pixel visited by each frame of a raster scan
+
+    Args:
+        shape (tuple): map shape (rows, columns)
+
+    Kwargs:
+        snake (bool): odd rows are scanned in reverse
+
+    Returns:
+        pixels (ndarray): flat pixel index for each frame
+
+    """
+    rows, cols = shape
+    pixels = np.arange(rows * cols).reshape(shape)
+    if snake:
+        pixels[1::2] = pixels[1::2,::-1]
+
+    return pixels.ravel()
+
+
+def position_index(positions, shape, extent):
+    """ Returns the pixel containing each position
+
+    Args:
+        positions (ndarray): positions of shape (frames, 2) as (x, y)
+
+        shape (tuple): map shape (rows, columns)
+
+        extent (tuple): map extent ((xmin, xmax), (ymin, ymax))
+
+    Returns:
+        pixels (ndarray): flat pixel index for each position, -1 if outside the map
+
+    """
+    positions = np.atleast_2d(np.asarray(positions, dtype=float))
+    rows, cols = shape
+    (xmin, xmax), (ymin, ymax) = extent
+
+    col = np.floor((positions[:,0] - xmin) / (xmax - xmin) * cols).astype(int)
+    row = np.floor((positions[:,1] - ymin) / (ymax - ymin) * rows).astype(int)
+
+    pixels = row * cols + col
+    pixels[(col < 0) | (col >= cols) | (row < 0) | (row >= rows)] = -1
+
+    return pixels
+
+
+class FlyScan:
+    """Hardware Triggered Fly Scan
+
+    Runs the device in External trigger mode with one frame per position from
+    a motion controller. Each frame is tagged with its position and mapped to
+    a pixel, and the ROI maps are filled in as frames arrive
+
+    Positions come from, in order of preference, an array of the positions the
+    controller will trigger at, a pair of position PVs read as each frame
+    arrives, or the frame order of a plain raster
+
+    Example:
+      >>> fly = FlyScan(x3, (50, 100), rois={'Fe': (6200, 6600)}, calibration=cal)
+      >>> fly.acquire()
+      >>> while x3.acquiring():
+      >>>     plot(fly.maps()['Fe'])
+    """
+
+    def __init__(self, x3, shape, rois, calibration=None, positions=None, position_pvs=None,
+                 extent=None, snake=False, dtc=False, logger=None):
+        """ Create a fly scan
+
+        Args:
+            x3 (Xspress3): the device to scan with
+
+            shape (tuple): map shape (rows, columns)
+
+            rois (dict): ROI name to (emin, emax) in eV, or (first bin, last bin)
+            without a calibration
+
+        Kwargs:
+            calibration (Calibration): energy calibration for the ROIs
+
+            positions (ndarray): (x, y) position of each trigger, of shape (frames, 2)
+
+            position_pvs (tuple): x and y position PV names, read as each frame arrives
+
+            extent (tuple): map extent ((xmin, xmax), (ymin, ymax)), required with
+            positions or position_pvs
+
+            snake (bool): raster scan with odd rows reversed
+
+            dtc (bool): dead time correct the ROI sums
+
+        """
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._x3 = x3
+        self._shape = tuple(shape)
+        self._dtc = dtc
+        self._extent = extent
+        self._lock = threading.Lock()
+
+        self._names = sorted(rois.keys())
+        bounds = []
+        for n in self._names:
+            lo, hi = rois[n]
+            if calibration is not None:
+                lo = int(np.ceil(np.max(calibration.bin(lo))))
+                hi = int(np.floor(np.min(calibration.bin(hi))))
+                hi = min(hi, calibration.bins() - 1)
+            lo = max(lo, 0)
+            assert lo <= hi, 'ROI {roi} is empty'.format(roi=n)
+            bounds.append((lo, hi))
+        self._bounds = np.array(bounds, dtype=int)
+
+        self._position_pvs = None
+        if positions is not None:
+            assert extent is not None, 'Map extent required with positions'
+            self._positions = np.atleast_2d(np.asarray(positions, dtype=float))
+            self._pixels = position_index(self._positions, self._shape, extent)
+
+        elif position_pvs is not None:
+            assert extent is not None, 'Map extent required with position PVs'
+            self._position_pvs = [MonitorPV(pv) for pv in position_pvs]
+            self._positions = np.full((self.frames(), 2), np.nan)
+            self._pixels = np.full(self.frames(), -1, dtype=int)
+
+        else:
+            self._pixels = raster_index(self._shape, snake)
+            self._positions = None
+
+        self.reset()
+        x3.add_frame_callback(self._frame)
+
+
+    def frames(self):
+        """ Returns the number of frames in the scan
+
+        Returns:
+            frames (int): number of frames
+        """
+        if self._position_pvs is None:
+            return len(self._pixels)
+
+        return self._shape[0] * self._shape[1]
+
+
+    def _clear_maps(self):
+        with self._lock:
+            self._maps = np.zeros((len(self._names),) + self._shape)
+            self._hits = np.zeros(self._shape, dtype=int)
+
+
+    def reset(self):
+        """ Clear the maps and position tags """
+
+        self._clear_maps()
+        with self._lock:
+            if self._position_pvs is not None:
+                self._positions[:] = np.nan
+                self._pixels[:] = -1
+
+
+    def acquire(self):
+        """ Configure the device for the scan and start acquiring
+
+        Sets External triggering with one image per frame of the scan
+        """
+        self.reset()
+        self._x3.set(trigger_mode='External', num_images=self.frames())
+        self._x3.acquire()
+
+
+    def _frame(self, frame_number):
+        frame = frame_number - 1
+        if frame < 0 or frame >= self.frames():
+            return
+
+        sums = aggregate.roi_sums(self._x3.sum_mca(dtc=self._dtc), self._bounds)
+
+        with self._lock:
+            if self._position_pvs is not None:
+                self._positions[frame] = [pv.value() for pv in self._position_pvs]
+                self._pixels[frame] = position_index(self._positions[frame], self._shape, self._extent)[0]
+
+            pixel = self._pixels[frame]
+            if pixel < 0:
+                return
+
+            row, col = divmod(pixel, self._shape[1])
+            self._maps[:, row, col] += sums
+            self._hits[row, col] += 1
+
+
+    def fill(self, h5, block=1024):
+        """ Fill the maps from a saved hdf5 file
+
+        Uses the channel mask of the HDF5 object
+
+        Positions recorded from position PVs during the scan are kept
+
+        Args:
+            h5 (HDF5): the file of the scan
+
+        Kwargs:
+            block (int): number of frames read at a time
+
+        """
+        self._clear_maps()
+
+        frames = min(h5.size()['frames'], len(self._pixels))
+        pixels = self._pixels[:frames]
+        size = self._shape[0] * self._shape[1]
+        valid = pixels >= 0
+
+        maps = np.zeros((len(self._names), size))
+        for s in range(0, frames, block):
+            sl = slice(s, min(s+block, frames))
+            sums = aggregate.roi_sums(h5.sum_mca(sl, dtc=self._dtc), self._bounds)
+            ok = valid[sl]
+            for r in range(len(self._names)):
+                maps[r] += np.bincount(pixels[sl][ok], weights=sums[ok,r], minlength=size)
+
+        with self._lock:
+            self._maps = maps.reshape((len(self._names),) + self._shape)
+            self._hits = np.bincount(pixels[valid], minlength=size).reshape(self._shape)
+
+
+    def maps(self):
+        """ Returns the ROI maps
+
+        Returns:
+            maps (dict): ROI name to map of shape (rows, columns)
+
+        """
+        with self._lock:
+            return dict((n, self._maps[i].copy()) for i, n in enumerate(self._names))
+
+
+    def hits(self):
+        """ Returns the number of frames summed into each pixel
+
+        Returns:
+            hits (ndarray): frames per pixel, of shape (rows, columns)
+
+        """
+        with self._lock:
+            return self._hits.copy()
+
+
+    def pixels(self):
+        """ Returns the frame to pixel map index
+
+        Returns:
+            pixels (ndarray): flat pixel index for each frame, -1 if unmapped
+
+        """
+        return self._pixels.copy()
+
+
+    def positions(self):
+        """ Returns the position tagged to each frame
+
+        Returns:
+            positions (ndarray): (x, y) for each frame, of shape (frames, 2), or
+            None for a plain raster
+
+        """
+        return None if self._positions is None else self._positions.copy()
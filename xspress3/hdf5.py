@@ -4,6 +4,9 @@ import logging
 import h5py
 import numpy as np
 
+from . import aggregate
+from . import subframes as sf
+
 
 class HDF5:
     """Xspress 3 HDF5 Parser
@@ -20,27 +23,66 @@ class HDF5:
       >>> [0,0,0....0]
     """
 
-    def __init__(self, file, logger=None):
+    def __init__(self, file, logger=None, lazy=False, subframes=1, memmap=True):
         """ Create an Xspress 3 HDF5 parser instance
 
         Args:
             file (string): the hdf5 file to open
 
+        Kwargs:
+            lazy (bool): read frames from disk as they are accessed rather than
+            loading the whole dataset up front
+
+            subframes (int): number of subframes per frame, for files from a subframe IOC
+
+            memmap (bool): map uncompressed contiguous data straight from the file
+            rather than reading it through h5py, takes precedence over lazy
+
         """
         self.logger = logger or logging.getLogger(__name__)
 
         self.logger.info('Loading {file}'.format(file=file))
-        self._file = h5py.File(file, 'r')
-        self._data = np.array(self._file.get('entry/instrument/detector/data'))
+        # Large chunk cache so lazy reads of chunked files decompress each chunk once
+        self._file = h5py.File(file, 'r', rdcc_nbytes=64*1024**2)
+        self._data = self._file.get('entry/instrument/detector/data')
 
+        self._memmap = memmap and self._mappable(self._data)
+        if self._memmap:
+            self._data = np.memmap(file, mode='r', dtype=self._data.dtype, shape=self._data.shape, offset=self._data.id.get_offset())
+        elif not lazy:
+            self._data = np.array(self._data)
+
+        self._dtype = self._data.dtype
         self._frames = self._data.shape[0]
         self._channels = self._data.shape[1]
         self._bins = self._data.shape[2]
+        self._subframes = subframes
+
+        assert self._bins % subframes == 0, '{bins} bins cannot hold {sf} subframes'.format(bins=self._bins, sf=subframes)
 
         self.logger.debug('Data is of size: {chans} channels, {frames} frames, {bins} bins per MCA'.format(chans=self._channels, frames=self._frames, bins=self._data.shape[2]))
 
         self._attrs = self._file.get('entry/instrument/detector/NDAttributes')
 
+        # Repacked files hold the per channel attributes in one table
+        self._table = self._file.get('entry/instrument/detector/scalars')
+        if self._table is not None:
+            self._columns = dict((str(c), i) for i, c in enumerate(self._table.attrs['columns']))
+
+        self._mask = aggregate.channel_mask(self._channels)
+
+
+    @staticmethod
+    def _mappable(ds):
+        # Contiguous, unfiltered data already written to the file
+        if ds.chunks is not None or ds.compression is not None or ds.external:
+            return False
+
+        if ds.dtype.hasobject or ds.id.get_offset() is None:
+            return False
+
+        return ds.id.get_storage_size() == ds.size * ds.dtype.itemsize
+
 
     def __enter__(self):
         return self
@@ -59,21 +101,46 @@ class HDF5:
                 * channels (int): number of channels in the file
                 * frames (int): number of frames in the file
                 * bins (int): number of bins per mca in the file
+                * subframes (int): number of subframes per frame
 
         """
         return {
             'channels': self._channels,
             'frames': self._frames,
-            'bins': self._bins
+            'bins': self._bins,
+            'subframes': self._subframes,
         }
 
 
+    def memmapped(self):
+        """ Returns whether the data are memory mapped from the file
+
+        Returns:
+            memmapped (bool): True for uncompressed contiguous data
+        """
+        return self._memmap
+
+
     def close(self):
-        """ Manually close the hdf5 file """
+        """ Manually close the hdf5 file
+
+        Data loaded into memory stay readable, memory mapped and lazily read
+        data do not
+        """
+
+        # The mapping holds the file open until it is released, arrays already
+        # returned are views of it and keep it open until they are freed
+        if self._memmap or not isinstance(self._data, np.ndarray):
+            self._data = None
 
         self._file.close()
 
 
+    def _mcas(self):
+        assert self._data is not None, 'MCAs cannot be read once the file is closed, open with memmap=False and lazy=False to keep them'
+        return self._data
+
+
     def mca(self, chan, frameno):
         """ Returns the specified MCA
 
@@ -89,7 +156,30 @@ class HDF5:
         assert chan < self._channels, 'Channel {chan} out of range of channels {chans}'.format(chan=chan, chans=self._channels)
         assert frameno < self._frames, 'Frame no {fr} out of range of frames {frs}'.format(fr=frameno, frs=self._frames)
 
-        return self._data[frameno,chan,:].astype(int).tolist()
+        return self._mcas()[frameno,chan,:].astype(int).tolist()
+
+
+    def mcas(self, frames=None, chans=None, bins=None):
+        """ Returns a block of MCAs
+
+        >>> h5.mcas(slice(0, 100)).shape
+        >>> (100, 4, 4096)
+
+        Kwargs:
+            frames (int|slice): the frame or frames to return, defaults to all frames
+
+            chans (int|slice): the channel or channels to return, defaults to all channels
+
+            bins (slice): the bins to return, defaults to all bins
+
+        Returns:
+            mcas (ndarray): the MCAs, of shape (frames, channels, bins), less any
+            axis selected with an int
+
+        """
+        frames, chans, bins = [slice(None) if s is None else s for s in (frames, chans, bins)]
+
+        return np.asarray(self._mcas()[frames, chans, bins])
 
 
     def sca(self, chan, frameno, sca):
@@ -120,11 +210,7 @@ class HDF5:
         assert chan < self._channels, 'Channel {chan} out of range of channels {chans}'.format(chan=chan, chans=self._channels)
         assert frameno < self._frames, 'Frame no {fr} out of range of frames {frs}'.format(fr=frameno, frs=self._frames)
 
-        attrid = 'CHAN{chan}SCA{sca}'.format(chan=(chan+1), sca=sca)
-        attr = np.array(self._attrs.get(attrid))
-
-        assert attr is not None, 'No such attribute {attr}'.format(attr=attrid)
-        return attr[frameno]
+        return self._attr('SCA{sca}'.format(sca=sca), chan, frameno)
 
 
     def dtc(self, chan, frameno):
@@ -144,15 +230,209 @@ class HDF5:
         assert chan < self._channels, 'Channel {chan} out of range of channels {chans}'.format(chan=chan, chans=self._channels)
         assert frameno < self._frames, 'Frame no {fr} out of range of frames {frs}'.format(fr=frameno, frs=self._frames)
 
-        dtfid = 'CHAN{chan}DTFACTOR'.format(chan=(chan+1))
-        dtf = np.array(self._attrs.get(dtfid))
+        return [self._attr('DTFACTOR', chan, frameno), self._attr('DTPERCENT', chan, frameno)]
+
+
+    def attributes(self):
+        """ Returns the names of the per channel attributes in the file
+
+        Returns:
+            attributes (list[string]): attribute names without the channel prefix,
+            eg. SCA0, DTFACTOR
+
+        """
+        if self._table is not None:
+            return sorted(self._columns)
+
+        if self._attrs is None:
+            return []
+
+        return sorted(str(k[len('CHAN1'):]) for k in self._attrs.keys() if k.startswith('CHAN1') and not k[len('CHAN1')].isdigit())
+
+
+    def _attr(self, name, chan, frames):
+        if self._table is not None:
+            assert name in self._columns, 'No such attribute {attr}'.format(attr=name)
+            return self._table[frames, chan, self._columns[name]]
+
+        attrid = 'CHAN{chan}{name}'.format(chan=(chan+1), name=name)
+        attr = self._attrs.get(attrid)
+
+        assert attr is not None, 'No such attribute {attr}'.format(attr=attrid)
+        return attr[frames]
+
+
+    def _attr_table(self, name, frames):
+        if frames is None:
+            frames = slice(None)
+
+        if self._table is not None:
+            assert name in self._columns, 'No such attribute {attr}'.format(attr=name)
+            return np.asarray(self._table[frames, :, self._columns[name]])
+
+        return np.moveaxis(np.array([self._attr(name, c, frames) for c in range(self._channels)]), 0, -1)
+
+
+    def scas(self, sca, frames=None):
+        """ Returns the specified scalar for all channels
+
+        Args:
+            sca (int): scalar to return, see :meth:`sca`
+
+        Kwargs:
+            frames (int|slice): the frame or frames to return, defaults to all frames
+
+        Returns:
+            scalars (ndarray): the scalar, of shape (frames, channels) or (channels,)
+            for a single frame
+
+        """
+        return self._attr_table('SCA{sca}'.format(sca=sca), frames)
+
+
+    def dtcs(self, frames=None):
+        """ Returns the dead time correction factors for all channels
 
-        assert dtf is not None, 'No such attribute {attr}'.format(attr=dtfid)
+        Kwargs:
+            frames (int|slice): the frame or frames to return, defaults to all frames
+
+        Returns:
+            factors (ndarray): the correction factors, of shape (frames, channels)
+            or (channels,) for a single frame
+
+        """
+        return self._attr_table('DTFACTOR', frames)
+
+
+    def deadtimes(self, frames=None):
+        """ Returns the dead time percentages for all channels
+
+        Kwargs:
+            frames (int|slice): the frame or frames to return, defaults to all frames
+
+        Returns:
+            deadtimes (ndarray): the dead time percentages, of shape (frames, channels)
+            or (channels,) for a single frame
+
+        """
+        return self._attr_table('DTPERCENT', frames)
+
+
+    def set_channel_mask(self, mask=None, exclude=None):
+        """ Set the channels included in summed data
+
+        >>> h5.set_channel_mask(exclude=[3, 5])
+
+        Kwargs:
+            mask (list[bool]): channels to include, defaults to all channels
+
+            exclude (list[int]): bad channels to exclude, zero offset
+
+        """
+        self._mask = aggregate.channel_mask(self._channels, mask, exclude)
+
+
+    def channel_mask(self):
+        """ Returns the channels included in summed data
+
+        Returns:
+            mask (ndarray): boolean array of shape (channels,)
+
+        """
+        return self._mask.copy()
+
+
+    def sum_mca(self, frames=None, dtc=False):
+        """ Returns the MCA summed over the masked channels
+
+        Kwargs:
+            frames (int|slice): the frame or frames to sum, defaults to all frames
+
+            dtc (bool): weight each channel by its dead time correction factor
+
+        Returns:
+            mca (ndarray): the summed MCAs, of shape (frames, bins) or (bins,)
+            for a single frame
+
+        """
+        weights = self.dtcs(frames) if dtc else None
+        return aggregate.channel_sum(self.mcas(frames), self._mask, weights, spectra=True)
+
+
+    def sum_sca(self, sca, frames=None, dtc=False):
+        """ Returns the specified scalar summed over the masked channels
+
+        Args:
+            sca (int): scalar to sum, see :meth:`sca`
+
+        Kwargs:
+            frames (int|slice): the frame or frames to sum, defaults to all frames
+
+            dtc (bool): weight each channel by its dead time correction factor
+
+        Returns:
+            scalar (ndarray): the summed scalar, of shape (frames,) or a single
+            value for a single frame
+
+        """
+        weights = self.dtcs(frames) if dtc else None
+        return aggregate.channel_sum(self.scas(sca, frames), self._mask, weights)
+
+
+    def subframe_mcas(self, frames=None):
+        """ Returns a block of MCAs split into subframes
+
+        Args and layout as :func:`xspress3.subframes.subframe_view`, this is
+        a view onto the data when the file is not lazily loaded
+
+        Kwargs:
+            frames (int|slice): the frame or frames to return, defaults to all frames
+
+        Returns:
+            mcas (ndarray): the MCAs, of shape (frames, subframes, channels, bins)
+            or (subframes, channels, bins) for a single frame
+
+        """
+        return sf.subframe_view(self.mcas(frames), self._subframes)
+
+
+    def merge_subframes(self, factor=None, resolution=None, subframe_time=None, frames=None, block=256):
+        """ Returns MCAs with consecutive subframes merged
+
+        Frames are merged a block at a time so only the merged result is held
+        in memory. Give either a merge factor, or a target time resolution and
+        the subframe duration
+
+        >>> h5.merge_subframes(resolution=1e-3, subframe_time=1e-4).shape
+        >>> (100, 10, 4, 4096)
+
+        Kwargs:
+            factor (int): number of subframes to merge into each bin
+
+            resolution (float): target time resolution in seconds
+
+            subframe_time (float): duration of a subframe in seconds
+
+            frames (slice): the frames to merge, defaults to all frames
+
+            block (int): number of frames merged at a time
+
+        Returns:
+            mcas (ndarray): the merged MCAs, of shape (frames, merged subframes, channels, bins)
+
+        """
+        if factor is None:
+            assert resolution is not None and subframe_time is not None, 'Either a factor or a resolution and subframe time is required'
+            factor = sf.merge_factor(resolution, subframe_time)
 
-        dtpid = 'CHAN{chan}DTPERCENT'.format(chan=(chan+1))
-        dtp = np.array(self._attrs.get(dtpid))
+        start, stop, step = (frames or slice(None)).indices(self._frames)
+        assert step == 1, 'Frame slices must be contiguous'
 
-        assert dtf is not None, 'No such attribute {attr}'.format(attr=dtpid)
+        blocks = []
+        for s in range(start, stop, block):
+            blocks.append(sf.merge(self.mcas(slice(s, min(s+block, stop))), self._subframes, factor))
 
-        return [dtf[frameno], dtp[frameno]]
+        if not blocks:
+            return np.zeros((0, -(-self._subframes // factor), self._channels, self._bins // self._subframes), dtype=self._dtype)
 
+        return np.concatenate(blocks)
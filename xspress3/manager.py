@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _parallel(fn, items):
+    """ Call fn on each item in its own thread, re-raising the first error """
+    results = [None] * len(items)
+    errors = []
+
+    def run(i, item):
+        try:
+            results[i] = fn(item)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i, item)) for i, item in enumerate(items)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+class Xspress3Manager:
+    """Multiple Xspress 3 Device Manager
+
+    Runs several Xspress 3 devices as one. Devices are connected, configured
+    and armed in parallel, then started together. Their frame streams are
+    merged by frame number into a single combined frame with the channels of
+    each device concatenated in the order the prefixes were given
+
+    Example:
+      >>> x3s = Xspress3Manager(['XSPRESS3-A', 'XSPRESS3-B'])
+      >>> x3s.set(
+      >>>     exposure_time=1,
+      >>>     num_images=10
+      >>> )
+      >>> x3s.add_frame_callback(callback)
+      >>> x3s.acquire()
+    """
+
+    def __init__(self, prefixes, logger=None, subframes=False):
+        """ Connect to several Xspress 3 devices
+
+        Args:
+            prefixes (list[string]): the PV prefixes of the devices
+
+        Kwargs:
+            subframes (bool): enable subframe parmeters (special IOC required)
+
+        """
+        from . import Xspress3
+
+        self.logger = logger or logging.getLogger(__name__)
+
+        devices = _parallel(lambda p: Xspress3(p, subframes=subframes), list(prefixes))
+        self._devices = OrderedDict(zip(prefixes, devices))
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._latest = dict((p, 0) for p in self._devices)
+        self._updated = dict((p, None) for p in self._devices)
+        self._incomplete = 0
+        self._frame_callbacks = []
+
+        for p, x3 in self._devices.iteritems():
+            x3.add_frame_callback(self._device_frame(p))
+
+        self.logger.info('Managing {n} devices with {chans} channels'.format(n=len(self._devices), chans=self.channels()))
+
+
+    def devices(self):
+        """ Get the managed devices
+
+        Returns:
+            devices (OrderedDict): prefix to :class:`xspress3.Xspress3` device
+        """
+        return self._devices
+
+
+    def channels(self):
+        """ Get the total number of channels over all devices
+
+        Returns:
+            no_channels (int): The number of channels
+        """
+        return sum(x3.channels() for x3 in self._devices.values())
+
+
+    def set(self, **kwargs):
+        """ Set attributes on all devices
+
+        Kwargs:
+            see :meth:`xspress3.Xspress3.set`
+
+        """
+        _parallel(lambda x3: x3.set(**kwargs), self._devices.values())
+
+
+    def get(self, param=None):
+        """ Get the value of an attribute on all devices
+
+        Args:
+            param (string): parameter to return the value of
+
+        Returns:
+            values (dict): prefix to value
+
+        """
+        return dict((p, x3.get(param)) for p, x3 in self._devices.iteritems())
+
+
+    def add_frame_callback(self, callback):
+        """ Add a combined frame callback
+
+        The callback is called once every device has reported a frame, with the
+        frame number and the combined frame
+
+        >>> def callback(frame_number, frame):
+        >>>     print 'Frame {f} counts {c}'.format(f=frame_number, c=frame['mcas'].sum())
+        >>> x3s.add_frame_callback(callback)
+
+        The combined frame is a dict of
+
+            * mcas (ndarray): MCAs of all devices, (channels, bins)
+            * scalars (ndarray): scalars of all devices, (channels, scalars)
+            * devices (dict): prefix to that device's mcas and scalars
+
+        Args:
+            callback (callable): the callback to add to the list of frame callbacks
+
+        """
+        assert not callback in self._frame_callbacks, 'Callback already registered'
+        self._frame_callbacks.append(callback)
+
+
+    def _device_frame(self, prefix):
+        x3 = self._devices[prefix]
+
+        def callback(frame_number):
+            # Snapshot now, the live values move on with the next frame
+            snapshot = { 'mcas': x3.mcas(), 'scalars': x3.scas() }
+
+            with self._lock:
+                self._latest[prefix] = max(self._latest[prefix], frame_number)
+                self._updated[prefix] = time.time()
+                self._pending.setdefault(frame_number, {})[prefix] = snapshot
+
+                complete = None
+                if len(self._pending[frame_number]) == len(self._devices):
+                    complete = self._pending.pop(frame_number)
+
+                # Frames every device has moved past can never complete
+                oldest = min(self._latest.values())
+                for f in [f for f in self._pending if f < oldest]:
+                    del self._pending[f]
+                    self._incomplete += 1
+
+            if complete is not None:
+                self._combined_frame(frame_number, complete)
+
+        return callback
+
+
+    def _combined_frame(self, frame_number, snapshots):
+        frame = {
+            'mcas': np.concatenate([snapshots[p]['mcas'] for p in self._devices]),
+            'scalars': np.concatenate([snapshots[p]['scalars'] for p in self._devices]),
+            'devices': snapshots,
+        }
+
+        for c in self._frame_callbacks:
+            c(frame_number, frame)
+
+
+    def lag(self):
+        """ Returns how far each device is behind the most advanced device
+
+        Returns:
+            lag (dict): prefix to a dict of
+
+                * frames (int): frames behind the leading device
+                * seconds (float): time since the device last reported a frame
+
+        """
+        with self._lock:
+            lead = max(self._latest.values())
+            now = time.time()
+
+            return dict((p, {
+                'frames': lead - self._latest[p],
+                'seconds': None if self._updated[p] is None else now - self._updated[p],
+            }) for p in self._devices)
+
+
+    def incomplete_frames(self):
+        """ Returns the number of frames that could not be combined
+
+        A frame is incomplete when one or more devices dropped it
+
+        Returns:
+            incomplete (int): the number of incomplete frames in the last acquisition
+
+        """
+        return self._incomplete
+
+
+    def acquire(self, timeout=10):
+        """ Starts an acquisition on all devices
+
+        All devices are armed in parallel, then started back to back
+
+        Kwargs:
+            timeout (float): seconds to wait for the acquisitions to start, None for forever
+
+        Returns:
+            started (bool): False if any device did not start within the timeout
+        """
+        with self._lock:
+            self._pending = {}
+            self._latest = dict((p, 0) for p in self._devices)
+            self._updated = dict((p, None) for p in self._devices)
+            self._incomplete = 0
+
+        _parallel(lambda x3: x3._arm(), self._devices.values())
+        time.sleep(0.2)
+
+        for x3 in self._devices.values():
+            x3._start()
+
+        return all(_parallel(lambda x3: x3._wait_acquiring(timeout), self._devices.values()))
+
+
+    def stop(self):
+        """ Stops the acquisition on all devices """
+
+        for x3 in self._devices.values():
+            x3.stop()
+
+
+    def acquiring(self):
+        """ Returns the acquisition status
+
+        Returns:
+            acquiring (bool): whether any device is still acquiring
+
+        """
+        return any(x3.acquiring() for x3 in self._devices.values())
+
+
+    def num_acquired(self):
+        """ Returns the number of frames acquired by every device
+
+        Returns:
+            num_acquired (int): the number of frames acquired by the slowest device
+
+        """
+        return min(x3.num_acquired() for x3 in self._devices.values())
@@ -1,26 +1,256 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+import time
+
+import numpy as np
 from epics import PV
 
-class MonitorPV:
-    _value = None
-    _pv = None
-    _pv_string = None
-    _is_string = False
 
-    def __init__(self, pv, is_string=False, logger=None):
-        self.logger = logger or logging.getLogger(__name__)
+_logger = logging.getLogger(__name__)
+_cond_lock = threading.Lock()
+
+
+class MonitorPV(object):
+    """Monitored PV
+
+    Keeps the latest value of a PV along with its EPICS timestamp, severity and
+    an update sequence number. The four are published as one tuple, so readers
+    always see a consistent set without taking a lock. Optionally keeps a
+    preallocated ring of the last n updates, NumPy backed for numeric PVs
+
+    Example:
+      >>> pv = MonitorPV('XSPRESS3-EXAMPLE:Acquire_RBV', history=10)
+      >>> pv.wait_for(lambda v: v == 1, timeout=5)
+      >>> pv.state()
+      >>>
+      >>> (1, 1518000000.0, 3)
+    """
+
+    __slots__ = ('logger', '_pv', '_pv_string', '_is_string', '_state', '_cond',
+                 '_size', '_ring', '_ring_ts', '_ring_seq')
+
+    def __init__(self, pv, is_string=False, logger=None, history=0, condition=None):
+        """ Monitor a PV
+
+        Args:
+            pv (string): the PV name
+
+        Kwargs:
+            is_string (bool): keep the char value of the PV
+
+            history (int): number of updates to keep, 0 for none
+
+            condition (threading.Condition): condition notified on every update,
+            to wait on several PVs at once. Created on first use if not given
+
+        """
+        self.logger = logger or _logger
 
         self._is_string = is_string
         self._pv_string = pv
+        self._state = (None, None, 0, None)
+        self._cond = condition
+
+        self._size = history
+        self._ring = None
+        self._ring_ts = None
+        self._ring_seq = None
+
         self._pv = PV(pv, self._update_callback, auto_monitor=True)
 
 
     def _update_callback(self, **kwargs):
-        self.logger.debug('PV Changed {pv}: {val}'.format(pv=kwargs['pvname'], val=kwargs['value']))
-        self._value = kwargs['value'] if not self._is_string else kwargs['char_value']
+        value = kwargs['value'] if not self._is_string else kwargs['char_value']
+        seq = self._state[2] + 1
+
+        if self._size:
+            self._record(value, kwargs.get('timestamp'), seq)
+
+        # Publish in one assignment
+        self._state = (value, kwargs.get('timestamp'), seq, kwargs.get('severity'))
+
+        cond = self._cond
+        if cond is not None:
+            with cond:
+                cond.notify_all()
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('PV Changed {pv}: {val}'.format(pv=self._pv_string, val=value))
+
+
+    def _record(self, value, timestamp, seq):
+        if self._ring is None:
+            if self._is_string or value is None:
+                self._ring = [None] * self._size
+            else:
+                value = np.asarray(value)
+                dtype = value.dtype if value.ndim else float
+                self._ring = np.zeros((self._size,) + value.shape, dtype=dtype)
+            self._ring_ts = np.full(self._size, np.nan)
+            self._ring_seq = np.zeros(self._size, dtype=np.int64)
+
+        i = seq % self._size
+        if isinstance(self._ring, list):
+            self._ring[i] = value
+        elif self._ring.ndim > 1:
+            value = np.asarray(value).ravel()[:self._ring.shape[1]]
+            self._ring[i,:len(value)] = value
+            self._ring[i,len(value):] = 0
+        else:
+            self._ring[i] = value
+
+        self._ring_ts[i] = timestamp if timestamp is not None else np.nan
+        self._ring_seq[i] = seq
+
+
+    def name(self):
+        """ Returns the PV name
+
+        Returns:
+            name (string): the PV name
+        """
+        return self._pv_string
 
 
     def value(self):
-        return self._value
+        """ Returns the latest value
+
+        Returns:
+            value (mixed): the value, None before the first update
+        """
+        return self._state[0]
+
+
+    def timestamp(self):
+        """ Returns the EPICS timestamp of the latest value
+
+        Returns:
+            timestamp (float): seconds since the epoch
+        """
+        return self._state[1]
+
+
+    def sequence(self):
+        """ Returns the number of updates received
+
+        Returns:
+            sequence (int): the update count, which identifies the latest value
+        """
+        return self._state[2]
+
+
+    def severity(self):
+        """ Returns the alarm severity of the latest value
+
+        Returns:
+            severity (int): the EPICS alarm severity
+        """
+        return self._state[3]
+
+
+    def state(self):
+        """ Returns a consistent value, timestamp and sequence
+
+        Returns:
+            state (tuple): (value, timestamp, sequence)
+        """
+        value, timestamp, seq, severity = self._state
+        return value, timestamp, seq
+
+
+    def age(self):
+        """ Returns how long ago the latest value was timestamped
+
+        Returns:
+            age (float): seconds, None before the first update
+        """
+        timestamp = self._state[1]
+        return None if timestamp is None else time.time() - timestamp
+
+
+    def history(self):
+        """ Returns the recorded updates, oldest first
+
+        An update arriving while the history is copied may replace its oldest entry
+
+        Returns:
+            history (tuple): (values, timestamps, sequences), values is an ndarray
+            of shape (updates, ...) for numeric PVs or a list otherwise
+        """
+        assert self._size, 'History is not enabled for {pv}'.format(pv=self._pv_string)
+
+        seq = self._state[2]
+        if self._ring is None or seq == 0:
+            return [], np.zeros(0), np.zeros(0, dtype=np.int64)
+
+        count = min(seq, self._size)
+        order = np.arange(seq - count + 1, seq + 1) % self._size
+
+        if isinstance(self._ring, list):
+            values = [self._ring[i] for i in order]
+        else:
+            values = self._ring[order]
+
+        return values, self._ring_ts[order], self._ring_seq[order]
+
+
+    def condition(self):
+        """ Returns the condition notified on every update
+
+        Returns:
+            condition (threading.Condition): the condition
+        """
+        if self._cond is None:
+            with _cond_lock:
+                if self._cond is None:
+                    self._cond = threading.Condition()
+
+        return self._cond
+
+
+    def wait_for(self, predicate, timeout=None):
+        """ Block until the value satisfies a predicate
+
+        >>> pv.wait_for(lambda v: v == 0, timeout=10)
+
+        Args:
+            predicate (callable): called with the latest value
+
+        Kwargs:
+            timeout (float): seconds to wait, defaults to forever
+
+        Returns:
+            satisfied (bool): False if the timeout expired
+        """
+        return wait_for(self.condition(), lambda: predicate(self._state[0]), timeout)
+
+
+
+def wait_for(condition, predicate, timeout=None):
+    """ Block on a condition until a predicate is true
+
+    Use with MonitorPVs sharing a condition to wait on several PVs at once
+
+    Args:
+        condition (threading.Condition): the condition the PVs notify
+
+        predicate (callable): called with no arguments
+
+    Kwargs:
+        timeout (float): seconds to wait, defaults to forever
+
+    Returns:
+        satisfied (bool): False if the timeout expired
+    """
+    end = None if timeout is None else time.time() + timeout
+
+    with condition:
+        while not predicate():
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            condition.wait(remaining)
+
+    return True
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+import numpy as np
+
+
+TICKS_PER_SECOND = 80e6
+
+METRICS = ('icr', 'ocr', 'deadtime')
+
+
+class RateMonitor:
+    """Live Count Rate Monitor
+
+    Calculates per channel input rate, output rate and dead time from the
+    scalars of each frame as it arrives, independent of the MCAs. Rates are
+    smoothed over a window of frames with running sums, so each frame costs a
+    handful of vector operations over the channels however long the window
+
+    The dead time follows the same model as :func:`xspress3.aggregate.dtc_factors`:
+
+        * icr = AllEvent / live time, live time = (Time - ResetTicks) / clock
+        * ocr = AllGood / real time, real time = Time / clock
+        * deadtime = 100 * (1 - ocr / icr)
+
+    Example:
+      >>> rm = RateMonitor(x3, window=5)
+      >>> rm.add_threshold(lambda f, m, chans, vals: x3.stop(), deadtime=40)
+      >>> x3.acquire()
+      >>> rm.rates()['icr']
+    """
+
+    def __init__(self, x3, window=10, clock=TICKS_PER_SECOND, logger=None):
+        """ Monitor the count rates of a device
+
+        Args:
+            x3 (Xspress3): the device to monitor
+
+        Kwargs:
+            window (int): number of frames to smooth over
+
+            clock (float): scalar time ticks per second
+
+        """
+        assert window >= 1, 'Window must be at least one frame, got {w}'.format(w=window)
+
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._x3 = x3
+        self._window = window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._thresholds = []
+
+        self.reset()
+        x3.add_frame_callback(self._frame)
+
+
+    def reset(self):
+        """ Clear the smoothing window and threshold states
+
+        Channels still over a limit are reported again on the next frame
+        """
+
+        chans = self._x3.channels()
+        with self._lock:
+            self._ring = np.zeros((self._window, len(METRICS), chans))
+            self._sums = np.zeros((len(METRICS), chans))
+            self._latest = np.zeros((len(METRICS), chans))
+            self._count = 0
+            self._frame_number = None
+
+            for t in self._thresholds:
+                t['over'][:] = False
+
+
+    def _frame(self, frame_number):
+        ticks, reset, allevent, allgood = self._x3.scas([0, 1, 3, 4]).T
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            icr = allevent * self._clock / (ticks - reset)
+            ocr = allgood * self._clock / ticks
+            dt = 100 * (1 - ocr / icr)
+
+        latest = np.array([icr, ocr, dt])
+        latest[~np.isfinite(latest)] = 0
+
+        with self._lock:
+            i = self._count % self._window
+            self._sums += latest - self._ring[i]
+            self._ring[i] = latest
+            self._latest = latest
+            self._count += 1
+            self._frame_number = frame_number
+
+            smoothed = self._sums / min(self._count, self._window)
+
+        for t in self._thresholds:
+            self._check(t, frame_number, smoothed)
+
+
+    def _check(self, threshold, frame_number, smoothed):
+        values = smoothed[METRICS.index(threshold['metric'])]
+        over = values > threshold['limit']
+
+        # Only report channels as they cross the limit
+        crossed = over & ~threshold['over']
+        threshold['over'] = over
+
+        if crossed.any():
+            chans = np.flatnonzero(crossed)
+            self.logger.warning('Frame {f}: {metric} over {limit} on channels {chans}'.format(
+                f=frame_number, metric=threshold['metric'], limit=threshold['limit'], chans=chans.tolist()))
+            threshold['callback'](frame_number, threshold['metric'], chans, values[chans])
+
+
+    def add_threshold(self, callback, icr=None, ocr=None, deadtime=None):
+        """ Add a threshold callback
+
+        The callback is called when the smoothed value on one or more channels
+        rises above the limit, with the frame number, metric, channels that
+        crossed and their values
+
+        >>> def saturating(frame, metric, chans, values):
+        >>>     print 'Channels {c} at {v}% dead time'.format(c=chans, v=values)
+        >>> rm.add_threshold(saturating, deadtime=30)
+
+        Args:
+            callback (callable): the callback
+
+        Kwargs:
+            icr (float): input rate limit in counts per second
+
+            ocr (float): output rate limit in counts per second
+
+            deadtime (float): dead time limit in percent
+
+        """
+        limits = { 'icr': icr, 'ocr': ocr, 'deadtime': deadtime }
+        assert any(v is not None for v in limits.values()), 'A limit is required'
+
+        for metric, limit in limits.iteritems():
+            if limit is not None:
+                self._thresholds.append({
+                    'callback': callback,
+                    'metric': metric,
+                    'limit': limit,
+                    'over': np.zeros(self._x3.channels(), dtype=bool),
+                })
+
+
+    def rates(self, smoothed=True):
+        """ Returns the current rates
+
+        Kwargs:
+            smoothed (bool): average over the window, otherwise the latest frame
+
+        Returns:
+            rates (dict): arrays of shape (channels,)
+
+                * icr (ndarray): input count rate per second
+                * ocr (ndarray): output count rate per second
+                * deadtime (ndarray): dead time in percent
+                * frame (int): the last frame number, None before the first frame
+
+        """
+        with self._lock:
+            if smoothed:
+                values = self._sums / max(min(self._count, self._window), 1)
+            else:
+                values = self._latest.copy()
+            frame_number = self._frame_number
+
+        rates = dict(zip(METRICS, values))
+        rates['frame'] = frame_number
+
+        return rates
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import logging
+import re
+import time
+
+import h5py
+import numpy as np
+
+from . import hdf5
+
+
+logger = logging.getLogger(__name__)
+
+DATA = 'entry/instrument/detector/data'
+ATTRS = 'entry/instrument/detector/NDAttributes'
+TABLE = 'entry/instrument/detector/scalars'
+
+CHANNEL_ATTR = re.compile(r'^CHAN(\d+)(.+)$')
+
+
+def chunk_shape(layout, frames, channels, bins, frame_block=64, bin_block=512):
+    """ Returns the chunk shape for a data layout
+
+    Layouts:
+        * frame: one frame per chunk, as written by the IOC
+        * channel: a block of frames of one channel per chunk, for per channel
+          time series
+        * bins: a block of frames and bins of one channel per chunk, for ROI maps
+
+    Args:
+        layout (string|tuple): layout name, or an explicit chunk shape
+
+        frames (int): number of frames
+
+        channels (int): number of channels
+
+        bins (int): number of bins
+
+    Kwargs:
+        frame_block (int): frames per chunk for the channel and bins layouts
+
+        bin_block (int): bins per chunk for the bins layout
+
+    Returns:
+        chunks (tuple): the chunk shape
+
+    """
+    frame_block = max(min(frame_block, frames), 1)
+
+    layouts = {
+        'frame': (1, channels, bins),
+        'channel': (frame_block, 1, bins),
+        'bins': (frame_block, 1, min(bin_block, bins)),
+    }
+
+    if isinstance(layout, tuple):
+        return layout
+
+    assert layout in layouts, 'No such layout {layout}, available layouts are: {layouts}'.format(
+        layout=layout, layouts=','.join(layouts))
+
+    return layouts[layout]
+
+
+def repack(src, dst, layout='channel', compression='lzf', frame_block=64, bin_block=512):
+    """ Rewrite an Xspress 3 hdf5 file in a layout suited to analysis
+
+    The detector data are streamed a chunk row at a time into the new chunk
+    layout with the shuffle and compression filters applied. Per channel
+    NDAttributes are consolidated into a single (frames, channels, columns)
+    scalar table, which :class:`xspress3.hdf5.HDF5` reads in preference to
+    the individual attributes. Other attributes are copied as they are
+
+    >>> repack('/data/test1.hdf5', '/data/test1_packed.hdf5', layout='bins')
+
+    Args:
+        src (string): the file to repack
+
+        dst (string): the file to write
+
+    Kwargs:
+        layout (string|tuple): chunk layout, see :func:`chunk_shape`
+
+        compression (string): hdf5 compression filter, lzf, gzip or None
+
+        frame_block (int): frames per chunk
+
+        bin_block (int): bins per chunk for the bins layout
+
+    Returns:
+        chunks (tuple): the chunk shape written
+
+    """
+    with hdf5.HDF5(src, lazy=True) as h5, h5py.File(dst, 'w') as out:
+        size = h5.size()
+        frames, channels, bins = size['frames'], size['channels'], size['bins']
+        chunks = chunk_shape(layout, frames, channels, bins, frame_block, bin_block)
+
+        logger.info('Repacking {src} to {dst} with chunks {chunks}'.format(src=src, dst=dst, chunks=chunks))
+
+        data = out.create_dataset(DATA, shape=(frames, channels, bins), dtype=h5._data.dtype,
+                                  chunks=chunks, compression=compression, shuffle=compression is not None)
+
+        # Write whole chunk rows so no chunk is compressed twice
+        for s in range(0, frames, chunks[0]):
+            sl = slice(s, min(s + chunks[0], frames))
+            data[sl] = h5.mcas(sl)
+
+        if h5._attrs is not None:
+            _consolidate(h5._attrs, out, frames, channels, compression)
+
+    return chunks
+
+
+def _consolidate(attrs, out, frames, channels, compression):
+    columns = []
+    group = out.create_group(ATTRS)
+
+    for name, attr in attrs.items():
+        match = CHANNEL_ATTR.match(name)
+        if match is None or int(match.group(1)) > channels:
+            group.create_dataset(name, data=attr[()])
+        elif match.group(2) not in columns:
+            columns.append(match.group(2))
+
+    columns.sort()
+    table = np.zeros((frames, channels, len(columns)))
+    for i, col in enumerate(columns):
+        for c in range(channels):
+            attr = attrs.get('CHAN{chan}{col}'.format(chan=(c+1), col=col))
+            if attr is not None:
+                table[:, c, i] = attr[()]
+
+    ds = out.create_dataset(TABLE, data=table, compression=compression)
+    ds.attrs['columns'] = np.array(columns, dtype='S')
+
+
+def _time(file, fn, repeats):
+    best = None
+    for r in range(repeats):
+        # Reopen each time so the hdf5 chunk cache starts cold, and read through
+        # h5py so contiguous originals are read rather than memory mapped
+        with hdf5.HDF5(file, lazy=True, memmap=False) as h5:
+            start = time.time()
+            fn(h5)
+            took = time.time() - start
+
+        best = took if best is None else min(best, took)
+
+    return best
+
+
+def benchmark(original, repacked, repeats=3, roi=(600, 700), frames=100):
+    """ Compare read times of an original and a repacked file
+
+    Each access pattern is timed on both files reading lazily through h5py,
+    best of repeats. Both files benefit equally from a warm OS cache, so run
+    on files larger than memory, or with a dropped cache, for cold numbers
+
+    Access patterns:
+        * channel: the full time series of one channel
+        * roi: an ROI window of bins over all frames and channels
+        * frames: random single frames
+
+    Args:
+        original (string): the original file
+
+        repacked (string): the repacked file
+
+    Kwargs:
+        repeats (int): number of times to repeat each read
+
+        roi (tuple): (first bin, last bin) of the ROI window
+
+        frames (int): number of random frames to read
+
+    Returns:
+        timings (dict): access pattern to a dict of original and repacked times in seconds
+
+    """
+    with hdf5.HDF5(original, lazy=True, memmap=False) as h5:
+        size = h5.size()
+
+    order = np.random.permutation(size['frames'])[:frames]
+    window = slice(roi[0], roi[1] + 1)
+
+    patterns = {
+        'channel': lambda h5: h5.mcas(chans=0),
+        'roi': lambda h5: h5.mcas(bins=window).sum(axis=2),
+        'frames': lambda h5: [h5.mcas(int(f)) for f in order],
+    }
+
+    timings = {}
+    for name, fn in patterns.items():
+        timings[name] = {
+            'original': _time(original, fn, repeats),
+            'repacked': _time(repacked, fn, repeats),
+        }
+
+        logger.info('{name}: original {o:.3f}s repacked {r:.3f}s'.format(
+            name=name, o=timings[name]['original'], r=timings[name]['repacked']))
+
+    return timings
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from epics import caput
+
+from .monitorpv import MonitorPV, wait_for
+
+
+class SequenceAborted(Exception):
+    """Raised by :meth:`Sequencer.run` when the sequence is aborted"""
+
+
+class SequenceTimeout(Exception):
+    """Raised by :meth:`Sequencer.run` when a transition times out"""
+
+
+class Sequencer:
+    """Step Scan Sequencer
+
+    Runs a list of scan points back to back, one acquisition per point. Each
+    transition is driven by PV events rather than fixed sleeps: parameters are
+    put with completion callbacks, the acquisition is started as soon as the
+    device is idle, and the next point's parameters go out the moment the
+    previous point reaches its frame count. The overhead of every point is
+    reported
+
+    Example:
+      >>> seq = Sequencer(x3, [
+      >>>     { 'exposure_time': 0.1, 'file_number': 1 },
+      >>>     { 'exposure_time': 0.2, 'file_number': 2 },
+      >>> ], file_saving=True)
+      >>> for p in seq.run():
+      >>>     print p['filename'], p['overhead']
+    """
+
+    def __init__(self, x3, points, file_saving=False, timeout=None, logger=None):
+        """ Create a sequencer
+
+        Args:
+            x3 (Xspress3): the device to run the points on
+
+            points (list[dict]): per point parameters, see :meth:`xspress3.Xspress3.set`
+
+        Kwargs:
+            file_saving (bool): enable hdf5 capture for every point
+
+            timeout (float): seconds to wait for any one transition, defaults to forever
+
+        """
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._x3 = x3
+        self._points = [dict(p) for p in points]
+        self._file_saving = file_saving
+        self._timeout = timeout
+        self._abort = False
+
+        self._cond = threading.Condition()
+        self._acq_status = MonitorPV(x3._pv('Acquire_RBV'), condition=self._cond)
+        self._counter = MonitorPV(x3._pv('ArrayCounter_RBV'), condition=self._cond)
+        self._capture = MonitorPV(x3._pv('HDF5:Capture_RBV'), condition=self._cond)
+
+
+    def _wait(self, predicate, what):
+        ok = wait_for(self._cond, lambda: self._abort or predicate(), self._timeout)
+
+        if self._abort:
+            raise SequenceAborted('Sequence aborted waiting for {what}'.format(what=what))
+
+        if not ok:
+            raise SequenceTimeout('Timed out waiting for {what}'.format(what=what))
+
+
+    def _idle(self):
+        return self._acq_status.value() == 0
+
+
+    def _capture_done(self):
+        return self._capture.value() == 0
+
+
+    def abort(self):
+        """ Stop the sequence and the current acquisition """
+
+        with self._cond:
+            self._abort = True
+            self._cond.notify_all()
+
+        self._x3.stop()
+
+
+    def run(self, callback=None):
+        """ Run every point in turn
+
+        Raises :class:`SequenceAborted` after :meth:`abort`, and :class:`SequenceTimeout`
+        if a transition takes longer than the timeout
+
+        Kwargs:
+            callback (callable): called with each point's report as it completes
+
+        Returns:
+            reports (list[dict]): one report per point
+
+                * point (int): the point index
+                * params (dict): the point parameters
+                * frames (int): frames acquired
+                * filename (string): the hdf5 file, if saving
+                * setup (float): seconds putting parameters and waiting for the device
+                * arm (float): seconds from arming to acquiring
+                * acquire (float): seconds acquiring
+                * overhead (float): seconds of the point not spent acquiring
+
+        """
+        self._abort = False
+
+        reports = []
+        for i, params in enumerate(self._points):
+            report = self._point(i, params)
+            reports.append(report)
+
+            self.logger.info('Point {i}: {frames} frames, overhead {o:.3f}s'.format(i=i, frames=report['frames'], o=report['overhead']))
+            if callback is not None:
+                callback(report)
+
+        self._wait(self._idle, 'acquisition to finish')
+        if self._file_saving:
+            self._wait(self._capture_done, 'file to close')
+
+        return reports
+
+
+    def _point(self, i, params):
+        start = time.time()
+
+        # Parameters go out while the IOC may still be finishing the last point
+        for p, v in params.iteritems():
+            self._x3._put(p, v, wait=True)
+
+        num_images = params.get('num_images', self._x3.get('num_images'))
+        self._wait(self._idle, 'device to be idle')
+
+        if self._file_saving:
+            # The plugin may still be writing the last point's frames, capturing
+            # again before it closes that file would do nothing
+            self._wait(self._capture_done, 'previous file to close')
+
+            # Capture stays busy until the file is closed, so don't wait on the put
+            caput(self._x3._pv('HDF5:Capture'), 1)
+            self._wait(lambda: self._capture.value() == 1, 'file capture')
+
+        setup = time.time()
+
+        self._x3._arm(wait=True)
+        caput(self._x3._pv('ArrayCounter'), 0, wait=True)
+        self._wait(lambda: self._counter.value() == 0, 'frame counter reset')
+
+        self._x3._start()
+        self._wait(lambda: self._acq_status.value() == 1 or self._counter.value() >= num_images, 'acquisition to start')
+        acquiring = time.time()
+
+        # Finish on the frame count, or when the IOC stops if counter updates were missed
+        self._wait(lambda: self._counter.value() >= num_images or self._idle(), 'frame count')
+        end = time.time()
+
+        return {
+            'point': i,
+            'params': params,
+            'frames': self._counter.value(),
+            'filename': self._x3.filename() if self._file_saving else None,
+            'setup': setup - start,
+            'arm': acquiring - setup,
+            'acquire': end - acquiring,
+            'overhead': acquiring - start,
+        }
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Subframe data handling
+
+With a subframe IOC each frame carries several subframes. The subframes of a
+channel are stored back to back in that channel's MCA, so a frame has shape
+(channels, subframes * bins) both in the live arrays and in the hdf5 file.
+These helpers present that data as (..., subframes, channels, bins) views and
+merge subframes down to a coarser time resolution without expanding it
+"""
+import numpy as np
+
+
+def subframe_view(data, subframes):
+    """ View data as separate subframes
+
+    Args:
+        data (ndarray): MCAs of shape (..., channels, subframes * bins)
+
+        subframes (int): number of subframes per frame
+
+    Returns:
+        view (ndarray): a view of shape (..., subframes, channels, bins)
+
+    """
+    data = np.asarray(data)
+    chans, length = data.shape[-2:]
+
+    assert length % subframes == 0, '{length} bins cannot hold {sf} subframes'.format(length=length, sf=subframes)
+
+    shape = data.shape[:-2] + (chans, subframes, length // subframes)
+    return data.reshape(shape).swapaxes(-3, -2)
+
+
+def merge_factor(resolution, subframe_time):
+    """ Returns the number of subframes to merge for a target time resolution
+
+    Args:
+        resolution (float): target time resolution in seconds
+
+        subframe_time (float): duration of a subframe in seconds
+
+    Returns:
+        factor (int): subframes per merged bin, at least 1
+
+    """
+    return max(int(round(float(resolution) / subframe_time)), 1)
+
+
+def merge(data, subframes, factor):
+    """ Merge consecutive subframes
+
+    The last merged bin is short if factor does not divide subframes
+
+    Args:
+        data (ndarray): MCAs of shape (..., channels, subframes * bins)
+
+        subframes (int): number of subframes per frame
+
+        factor (int): number of subframes to merge into each bin
+
+    Returns:
+        merged (ndarray): MCAs of shape (..., ceil(subframes / factor), channels, bins)
+
+    """
+    view = subframe_view(data, subframes)
+    if factor == 1:
+        return view
+
+    return np.add.reduceat(view, np.arange(0, subframes, factor), axis=-3)
@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import glob
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+
+from . import hdf5
+
+
+logger = logging.getLogger(__name__)
+
+SCALARS = 7
+
+# Per frame and per bin arrays, stored as npy members and read only when asked
+# for. Everything else is stored as json in the zip comment, so checking and
+# loading a sidecar never parses an npy header
+LAZY = ('frame_totals', 'spectrum', 'roi_frames')
+
+
+def sidecar(file):
+    """ Returns the summary sidecar path for an hdf5 file
+
+    Args:
+        file (string): the hdf5 file
+
+    Returns:
+        sidecar (string): the sidecar path, {file}.summary.npz
+
+    """
+    return '{file}.summary.npz'.format(file=file)
+
+
+class Summary:
+    """Xspress 3 HDF5 Summary
+
+    A summary of an hdf5 file, built once and saved alongside it as a sidecar.
+    The sidecar is reused for as long as the file's modification time and size
+    are unchanged, so the summary of a file that has already been seen loads
+    without opening the hdf5. Only the per file totals are held in memory, per
+    frame and per bin arrays are read from the sidecar as they are needed
+
+    Example:
+      >>> s = Summary(file, rois={'Fe': (630, 650)})
+      >>> s.roi('Fe').sum()
+      >>> s.deadtime()['mean']
+    """
+
+    def __init__(self, file, rois=None, rebuild=False, block=1024, build=True):
+        """ Load or build the summary of an hdf5 file
+
+        Args:
+            file (string): the hdf5 file to summarise
+
+        Kwargs:
+            rois (dict): ROI name to (first bin, last bin), summed per frame
+
+            rebuild (bool): rebuild the summary even if the sidecar is fresh
+
+            block (int): number of frames read at a time when building
+
+            build (bool): build the summary if there is no fresh sidecar, see :meth:`load`
+
+        """
+        self._file = file
+        rois = rois or {}
+
+        self._data = None if rebuild else self._load(file, rois)
+        if self._data is None and build:
+            self._data = self._build(file, rois, block)
+            if self._save():
+                for k in LAZY:
+                    del self._data[k]
+
+
+    @staticmethod
+    def _stat(file):
+        st = os.stat(file)
+        return st.st_mtime, st.st_size
+
+
+    @classmethod
+    def _load(cls, file, rois=None):
+        path = sidecar(file)
+        if not os.path.exists(path):
+            return None
+
+        with zipfile.ZipFile(path) as z:
+            comment = z.comment
+
+        if not comment:
+            logger.debug('Summary of {file} is from an older version'.format(file=file))
+            return None
+
+        meta = json.loads(comment)
+        if (meta['mtime'], meta['size']) != cls._stat(file):
+            logger.debug('Summary of {file} is stale'.format(file=file))
+            return None
+
+        stored = dict(zip(meta['roi_names'], meta['roi_bounds']))
+        for name, bounds in (rois or {}).iteritems():
+            if list(stored.get(name, ())) != list(bounds):
+                logger.debug('Summary of {file} is missing ROI {roi}'.format(file=file, roi=name))
+                return None
+
+        data = dict((k, np.array(v)) for k, v in meta.iteritems())
+        data['roi_names'] = np.array(meta['roi_names'], dtype='S')
+        data['roi_bounds'] = data['roi_bounds'].reshape(-1, 2)
+        data['roi_channels'] = data['roi_channels'].reshape(len(meta['roi_names']), meta['dims'][1])
+
+        return data
+
+
+    @classmethod
+    def load(cls, file, rois=None):
+        """ Load a summary only if its sidecar is fresh
+
+        Args:
+            file (string): the hdf5 file
+
+        Kwargs:
+            rois (dict): ROIs the summary must hold
+
+        Returns:
+            summary (Summary): the summary, or None if there is no fresh sidecar
+
+        """
+        summary = cls(file, rois=rois, build=False)
+        return summary if summary._data is not None else None
+
+
+    def _build(self, file, rois, block):
+        logger.info('Summarising {file}'.format(file=file))
+        mtime, size = self._stat(file)
+
+        names = sorted(rois.keys())
+        bounds = np.array([rois[n] for n in names], dtype=int).reshape(-1, 2)
+
+        with hdf5.HDF5(file, lazy=True) as h5:
+            dims = h5.size()
+            frames, channels, bins = dims['frames'], dims['channels'], dims['bins']
+            attrs = h5.attributes()
+            scalars = [s for s in range(SCALARS) if 'SCA{s}'.format(s=s) in attrs]
+
+            frame_totals = np.zeros(frames, dtype=np.int64)
+            spectrum = np.zeros((channels, bins), dtype=np.int64)
+            roi_frames = np.zeros((len(names), frames), dtype=np.int64)
+            roi_channels = np.zeros((len(names), channels), dtype=np.int64)
+
+            for s in range(0, frames, block):
+                sl = slice(s, min(s+block, frames))
+                mcas = h5.mcas(sl)
+
+                per_channel = mcas.sum(axis=2, dtype=np.int64)
+                frame_totals[sl] = per_channel.sum(axis=1)
+                spectrum += mcas.sum(axis=0, dtype=np.int64)
+
+                for i, (lo, hi) in enumerate(bounds):
+                    roi = mcas[:,:,lo:hi+1].sum(axis=2, dtype=np.int64)
+                    roi_frames[i,sl] = roi.sum(axis=1)
+                    roi_channels[i] += roi.sum(axis=0)
+
+            sca_totals = np.zeros((channels, SCALARS))
+            for s in scalars:
+                sca_totals[:,s] = h5.scas(s).sum(axis=0)
+
+            if 'DTPERCENT' in attrs and frames:
+                dt = h5.deadtimes()
+                dt_mean, dt_max = dt.mean(axis=0), dt.max(axis=0)
+            else:
+                dt_mean = dt_max = np.full(channels, np.nan)
+
+        return {
+            'mtime': np.float64(mtime),
+            'size': np.int64(size),
+            'dims': np.array([frames, channels, bins]),
+            'total': frame_totals.sum(),
+            'channel_totals': spectrum.sum(axis=1),
+            'frame_totals': frame_totals,
+            'spectrum': spectrum,
+            'sca_totals': sca_totals,
+            'dt_mean': dt_mean,
+            'dt_max': dt_max,
+            'roi_names': np.array(names, dtype='S'),
+            'roi_bounds': bounds,
+            'roi_frames': roi_frames,
+            'roi_channels': roi_channels,
+        }
+
+
+    def _save(self):
+        path = sidecar(self._file)
+        tmp = path + '.tmp'
+
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, **dict((k, self._data[k]) for k in LAZY))
+
+            meta = dict((k, v.tolist()) for k, v in self._data.iteritems() if k not in LAZY)
+            with zipfile.ZipFile(tmp, 'a') as z:
+                z.comment = json.dumps(meta)
+
+            replace(tmp, path)
+
+        except (IOError, OSError) as e:
+            logger.warning('Could not write summary {path}: {err}'.format(path=path, err=e))
+            return False
+
+        return True
+
+
+    def _get(self, key):
+        if key in self._data:
+            return self._data[key]
+
+        with np.load(sidecar(self._file)) as npz:
+            return npz[key]
+
+
+    def file(self):
+        """ Returns the summarised hdf5 file
+
+        Returns:
+            file (string): the hdf5 file
+        """
+        return self._file
+
+
+    def size(self):
+        """ Returns the dimensions of the hdf5 file
+
+        Returns:
+            size (dict): as :meth:`xspress3.hdf5.HDF5.size`
+        """
+        frames, channels, bins = self._data['dims'].tolist()
+        return { 'channels': channels, 'frames': frames, 'bins': bins }
+
+
+    def frame_totals(self):
+        """ Returns the total counts in each frame over all channels
+
+        Returns:
+            totals (ndarray): counts of shape (frames,)
+        """
+        return self._get('frame_totals')
+
+
+    def total(self):
+        """ Returns the total counts in the file
+
+        Returns:
+            total (int): the total counts
+        """
+        return int(self._data['total'])
+
+
+    def channel_totals(self):
+        """ Returns the total counts in each channel over all frames
+
+        Returns:
+            totals (ndarray): counts of shape (channels,)
+        """
+        return self._data['channel_totals']
+
+
+    def spectrum(self, chan=None):
+        """ Returns the MCA summed over all frames
+
+        Kwargs:
+            chan (int): channel to return, defaults to the sum of all channels
+
+        Returns:
+            spectrum (ndarray): counts of shape (bins,)
+        """
+        spectrum = self._get('spectrum')
+        if chan is None:
+            return spectrum.sum(axis=0)
+
+        return spectrum[chan]
+
+
+    def counts(self, lo, hi, chan=None):
+        """ Returns the counts in a bin window over the whole file
+
+        Args:
+            lo (int): first bin
+
+            hi (int): last bin
+
+        Kwargs:
+            chan (int): channel to count, defaults to all channels
+
+        Returns:
+            counts (int): the counts in the window
+        """
+        return int(self.spectrum(chan)[lo:hi+1].sum())
+
+
+    def sca_totals(self):
+        """ Returns each scalar summed over all frames
+
+        Returns:
+            totals (ndarray): of shape (channels, scalars), see :meth:`xspress3.hdf5.HDF5.sca`
+        """
+        return self._data['sca_totals']
+
+
+    def deadtime(self):
+        """ Returns dead time percentage statistics
+
+        Returns:
+            deadtime (dict):
+
+                * mean (float): mean over all channels and frames
+                * channel_mean (ndarray): mean per channel, (channels,)
+                * channel_max (ndarray): max per channel, (channels,)
+        """
+        return {
+            'mean': float(self._data['dt_mean'].mean()),
+            'channel_mean': self._data['dt_mean'],
+            'channel_max': self._data['dt_max'],
+        }
+
+
+    def rois(self):
+        """ Returns the ROIs in the summary
+
+        Returns:
+            rois (dict): ROI name to (first bin, last bin)
+        """
+        return dict(zip([str(n) for n in self._data['roi_names']], [tuple(b) for b in self._data['roi_bounds'].tolist()]))
+
+
+    def roi(self, name, channels=False):
+        """ Returns ROI sums
+
+        Args:
+            name (string): the ROI
+
+        Kwargs:
+            channels (bool): return the total per channel rather than per frame
+
+        Returns:
+            sums (ndarray): counts of shape (frames,), or (channels,)
+        """
+        names = [str(n) for n in self._data['roi_names']]
+        assert name in names, 'No such ROI {roi}'.format(roi=name)
+
+        i = names.index(name)
+        if channels:
+            return self._data['roi_channels'][i]
+
+        return self._get('roi_frames')[i]
+
+
+
+class Catalogue:
+    """Xspress 3 HDF5 Catalogue
+
+    Queries over many hdf5 files answered from their summary sidecars
+
+    Example:
+      >>> cat = Catalogue('/data/beamtime', build=True)
+      >>> cat.query(lambda s: s.counts(630, 650) > 1e6)
+      >>> ['/data/beamtime/scan12.hdf5', ...]
+    """
+
+    def __init__(self, paths, rois=None, build=False, logger=None):
+        """ Collect the summaries of a set of hdf5 files
+
+        Args:
+            paths (string|list[string]): files, globs or directories of hdf5 files
+
+        Kwargs:
+            rois (dict): ROIs the summaries must hold
+
+            build (bool): summarise files without a fresh sidecar, otherwise they
+            are listed in :meth:`missing`
+
+        """
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._summaries = []
+        self._missing = []
+
+        for file in find_files(paths):
+            summary = Summary.load(file, rois)
+            if summary is None and build:
+                summary = Summary(file, rois=rois)
+
+            if summary is None:
+                self._missing.append(file)
+            else:
+                self._summaries.append(summary)
+
+        self.logger.info('Catalogued {n} files, {m} without summaries'.format(n=len(self._summaries), m=len(self._missing)))
+
+
+    def summaries(self):
+        """ Returns the summaries in the catalogue
+
+        Returns:
+            summaries (list[Summary]): the summaries
+        """
+        return list(self._summaries)
+
+
+    def missing(self):
+        """ Returns files without a fresh summary
+
+        Returns:
+            files (list[string]): the files
+        """
+        return list(self._missing)
+
+
+    def query(self, predicate):
+        """ Returns the files whose summary matches a predicate
+
+        >>> cat.query(lambda s: s.deadtime()['mean'] > 20)
+
+        Args:
+            predicate (callable): called with each Summary
+
+        Returns:
+            files (list[string]): the matching files
+        """
+        return [s.file() for s in self._summaries if predicate(s)]
+
+
+    def table(self, fn):
+        """ Returns a value from every summary
+
+        >>> cat.table(lambda s: s.deadtime()['mean'])
+
+        Args:
+            fn (callable): called with each Summary
+
+        Returns:
+            values (dict): file to value
+        """
+        return dict((s.file(), fn(s)) for s in self._summaries)
+
+
+
+def replace(src, dst):
+    """ Rename a file over another
+
+    os.rename won't replace an existing file on Windows, and Python 2 has no
+    os.replace, so the target is removed first
+
+    Args:
+        src (string): the file to rename
+
+        dst (string): the new name, replaced if it exists
+
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def find_files(paths, pattern='*.hdf5'):
+    """ Expand files, globs and directories into a list of hdf5 files
+
+    Args:
+        paths (string|list[string]): files, globs or directories
+
+    Kwargs:
+        pattern (string): file pattern to match in directories
+
+    Returns:
+        files (list[string]): the sorted hdf5 files
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.update(os.path.join(root, n) for n in names if fnmatch.fnmatch(n, pattern))
+        else:
+            files.update(glob.glob(path))
+
+    return sorted(files)